@@ -169,6 +169,16 @@ class TestRunner(object):
                 report += '%s\n' % line
             report += '~~~~\n\n'
 
+            timing = hosts[host]['result'].get('script_timing', {})
+            if timing:
+                report += '### Instruction Timings (ms) ###\n~~~~\n'
+                for name in sorted(timing, key=lambda x: -timing[x]['total_ms']):
+                    report += '%-10s count %d total %.3f mean %.3f p99 %.3f max %.3f\n' % \
+                        (name, timing[name]['count'], timing[name]['total_ms'],
+                         timing[name]['mean_ms'], timing[name]['p99_ms'],
+                         timing[name]['max_ms'])
+                report += '~~~~\n\n'
+
             report += '### Broker Log ###\n~~~~\n'
             for line in hosts[host]['result']['broker_log'].split('\n'):
                 report += '%s\n' % line
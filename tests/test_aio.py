@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import uuid
+
+from unittest import SkipTest
+
+if sys.version_info < (3, 5):
+    raise SkipTest('zbroker.aio needs python 3.5+')
+
+import asyncio
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import zbroker
+from nose.tools import *
+
+# bytes the in-process pipes hold before a writer blocks
+CAPACITY = 4096
+
+class TestAsyncZpipe:
+    @classmethod
+    def setup_class(cls):
+        cls.previous = zbroker.set_backend(zbroker.InProcessBroker(capacity=CAPACITY))
+
+    @classmethod
+    def teardown_class(cls):
+        zbroker.set_backend(cls.previous)
+
+    def run(self, coro, timeout=5):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, timeout))
+
+    def setup(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        pipe_uuid = uuid.uuid4()
+        self.reader = self.run(zbroker.AsyncZpipe('local|%s' % pipe_uuid).open())
+        self.writer = self.run(zbroker.AsyncZpipe('local|>%s' % pipe_uuid).open())
+
+    def teardown(self):
+        self.run(self.writer.close())
+        self.run(self.reader.close())
+        self.loop.close()
+
+    def test_0100_read(self):
+        self.writer.write(b'hello')
+        self.run(self.writer.drain())
+
+        assert(self.run(self.reader.read(100)) == b'hello')
+
+    def test_0110_read_to_eof(self):
+        self.writer.write(b'hello')
+        self.run(self.writer.close())
+
+        assert(self.run(self.reader.read()) == b'hello')
+        assert(self.run(self.reader.read(1)) == b'')
+
+    def test_0120_readexactly(self):
+        self.writer.write(b'abc')
+        self.run(self.writer.drain())
+        self.writer.write(b'def')
+        self.run(self.writer.drain())
+
+        assert(self.run(self.reader.readexactly(6)) == b'abcdef')
+
+        self.writer.write(b'g')
+        self.run(self.writer.close())
+        try:
+            self.run(self.reader.readexactly(2))
+            assert(False)
+        except asyncio.IncompleteReadError as e:
+            assert(e.partial == b'g')
+
+    def test_0130_read_timeout(self):
+        try:
+            self.run(self.reader.read(1, timeout=200))
+            assert(False)
+        except zbroker.TimeoutError:
+            pass
+
+        # the pipe is still usable afterwards
+        self.writer.write(b'late')
+        self.run(self.writer.drain())
+        assert(self.run(self.reader.read(4)) == b'late')
+
+    def test_0140_cancelled_read_keeps_data(self):
+        task = self.loop.create_task(self.reader.readexactly(6))
+        self.writer.write(b'abc')
+        self.run(self.writer.drain())
+        self.run(asyncio.sleep(0.2))
+
+        task.cancel()
+        try:
+            self.loop.run_until_complete(task)
+            assert(False)
+        except asyncio.CancelledError:
+            pass
+
+        self.writer.write(b'def')
+        self.run(self.writer.drain())
+        assert(self.run(self.reader.readexactly(6)) == b'abcdef')
+
+    def test_0150_drain_waits_for_reader(self):
+        # far more than the pipe and the reader's read-ahead hold
+        payload = os.urandom(zbroker.aio.ASYNC_READ_AHEAD * 4)
+        self.writer.write(payload)
+
+        received = self.run(asyncio.gather(self.writer.drain(),
+                                           self.reader.readexactly(len(payload))))[1]
+        assert(received == payload)
+
+    def test_0160_cancelled_drain_completes_later(self):
+        # enough to fill the reader's read-ahead and then the pipe, so
+        # the second write is still in flight when cancelled
+        full = zbroker.aio.ASYNC_READ_AHEAD + CAPACITY
+        payload = os.urandom(full * 2)
+        self.writer.write(payload[:full])
+        self.run(self.writer.drain())
+        self.run(asyncio.sleep(0.2))
+        self.writer.write(payload[full:])
+
+        task = self.loop.create_task(self.writer.drain())
+        self.run(asyncio.sleep(0.2))
+        assert(not task.done())
+        task.cancel()
+        try:
+            self.loop.run_until_complete(task)
+            assert(False)
+        except asyncio.CancelledError:
+            pass
+
+        received = self.run(asyncio.gather(self.writer.drain(),
+                                           self.reader.readexactly(len(payload))))[1]
+        assert(received == payload)
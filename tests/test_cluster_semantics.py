@@ -45,7 +45,7 @@ class TestZpipeSemantics:
     @classmethod
     def setup_class(cls):
         # we could start a server as part of this
-        pass
+        zbroker.load_library()
 
     @classmethod
     def teardown_class(cls):
@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 
 import ctypes
+import ctypes.util
 import io
+import mmap
 import signal
 import errno
 import os
+import sys
+import time
+
+from collections import deque
 
 # set up some signal handlers
-from threading import currentThread
+from threading import currentThread, Condition, Lock, Thread, Timer
 
 class TimeoutError(Exception):
     pass
@@ -16,16 +22,151 @@ class TimeoutError(Exception):
 if currentThread().getName() == 'MainThread':
     signal.signal(signal.SIGINT, signal.SIG_DFL)
 
+# initial size of the receive buffer used by read()
+READ_BUFFER_SIZE = 65536
+
+# bytes requested from the native client per read call.  The default
+# can be overridden with ZPIPES_READ_CHUNK_SIZE, and ZPIPES_READ_ADAPTIVE=1
+# turns on adaptive sizing between the min and max.
+READ_CHUNK_SIZE = 4096
+READ_CHUNK_MIN = 1024
+READ_CHUNK_MAX = 4 * 1024 * 1024
+
+# how much of a file send_file/recv_to_file map at a time
+FILE_WINDOW_SIZE = 64 * 1024 * 1024
+
+# native read timeout (ms) used by the read-ahead thread, which bounds
+# how long closing a read-ahead pipe waits for the thread to stop
+READ_AHEAD_POLL = 100
+
+# threads open_many uses at most by default
+OPEN_MANY_WORKERS = 16
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long)]
+
+
+# clock ids for _clock_gettime
+_CLOCK_MONOTONIC = 6 if sys.platform == 'darwin' else 1
+_CLOCK_THREAD_CPUTIME_ID = 16 if sys.platform == 'darwin' else 3
+
+
+def _clock_gettime(clock_id):
+    """
+    clock_gettime(clock_id) through ctypes as a function returning
+    seconds, for python 2, which has neither time.monotonic nor
+    time.thread_time.  None where it can't be found.
+    """
+    for name in (ctypes.util.find_library('rt'), None):
+        try:
+            clock_gettime = ctypes.CDLL(name, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        clock_gettime.restype = ctypes.c_int
+
+        def clock():
+            ts = _timespec()
+            if clock_gettime(clock_id, ctypes.byref(ts)) != 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        return clock
+    return None
+
+
+# the clock deadlines, latencies and traces are measured with: python
+# 3's time.monotonic, CLOCK_MONOTONIC on python 2, and the wall clock
+# only where neither is available
+_monotonic = getattr(time, 'monotonic', None) or \
+             _clock_gettime(_CLOCK_MONOTONIC) or time.time
+
+# how a timeout applies to a read or write that takes several native
+# calls: TIMEOUT_PER_CALL hands the full timeout to each of them, while
+# TIMEOUT_DEADLINE makes it a budget for the whole operation.  The
+# default can be set with ZPIPES_TIMEOUT_MODE.
+TIMEOUT_PER_CALL = 'call'
+TIMEOUT_DEADLINE = 'deadline'
+TIMEOUT_MODES = (TIMEOUT_PER_CALL, TIMEOUT_DEADLINE)
+
+
+def _buffer_address(buf):
+    """ address of the first byte of a writable buffer, without copying """
+    return ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+
+
+def _c_value(arg):
+    """ the number behind a c_void_p/c_ulong, or a byref() of one """
+    arg = getattr(arg, '_obj', arg)
+    return getattr(arg, 'value', arg)
+
+
+def _deadline(timeout):
+    """ monotonic deadline for a timeout in ms, None for no timeout """
+    if timeout > 0:
+        return _monotonic() + timeout / 1000.0
+    return None
+
+
+def _remaining(timeout, deadline, what):
+    """
+    timeout to hand to the next native call: all of it without a
+    deadline, otherwise what is left of it (raising TimeoutError if
+    nothing is)
+    """
+    if deadline is None:
+        return timeout
+
+    remaining = int((deadline - _monotonic()) * 1000)
+    if remaining <= 0:
+        raise TimeoutError('%s Timeout' % what)
+    return remaining
+
+
+def _file_descriptor(path_or_fd, flags):
+    """
+    (fd, owned) for a path, a descriptor or an object with fileno().
+    Paths are opened with flags and owned by the caller, who closes them.
+    """
+    if isinstance(path_or_fd, int):
+        return path_or_fd, False
+    if hasattr(path_or_fd, 'fileno'):
+        return path_or_fd.fileno(), False
+    return os.open(path_or_fd, flags, 0o666), True
 
-class Zpipe(object):
-    def __init__(self, descriptor, read_timeout=0, write_timeout=0):
+
+def _readable_buffer(buf):
+    """
+    (address, length, owner) for a bytes-like object.  Bytes and
+    writable buffers (bytearray, mmap, ...) are used in place; anything
+    else is copied once.  owner keeps the addressed memory alive.
+    """
+    if isinstance(buf, bytes):
+        address = ctypes.cast(ctypes.c_char_p(buf), ctypes.c_void_p).value
+        return address, len(buf), buf
+
+    try:
+        return _buffer_address(buf), len(buf), buf
+    except TypeError:
+        data = memoryview(buf).tobytes()
+        return _readable_buffer(data)
+
+
+class ZpipesLib(object):
+    """
+    ctypes bindings for libzmtp/libzbroker_cli, the default backend.
+    Loading the shared objects and declaring the prototypes is done
+    once per process (see load_library()) and shared by every Zpipe.
+    """
+    def __init__(self, lib_path=None):
         zmtp_so="libzmtp.so"
         zpipesclient_so="libzbroker_cli.so"
 
-        if os.environ.get('ZPIPES_LIB_PATH'):
-            zmtp_so = os.path.join(os.environ['ZPIPES_LIB_PATH'], zmtp_so)
-            zpipesclient_so = os.path.join(os.environ['ZPIPES_LIB_PATH'], zpipesclient_so)
-
+        if lib_path:
+            zmtp_so = os.path.join(lib_path, zmtp_so)
+            zpipesclient_so = os.path.join(lib_path, zpipesclient_so)
 
         self.zpipes = ctypes.CDLL(zmtp_so, mode=ctypes.RTLD_GLOBAL)
         self.zpipesclient = ctypes.CDLL(zpipesclient_so, mode=ctypes.RTLD_GLOBAL)
@@ -43,18 +184,163 @@ class Zpipe(object):
         self.fn_error.restype = ctypes.c_int
 
         self.fn_open.argtypes = [ctypes.c_char_p, ctypes.c_char_p]
-        self.fn_read.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_int]
-        self.fn_write.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_int]
+        self.fn_read.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_ulong, ctypes.c_int]
+        self.fn_write.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_ulong, ctypes.c_int]
         self.fn_close.argtypes = [ctypes.POINTER(ctypes.c_void_p)]
         self.fn_error.argtypes = None
 
+
+_library = None
+_library_lock = Lock()
+
+_backends = { 'ctypes': lambda: ZpipesLib(os.environ.get('ZPIPES_LIB_PATH')) }
+
+
+def register_backend(name, factory):
+    """
+    Make a client backend available as ZPIPES_BACKEND=<name>.  factory()
+    returns an object with the client library's calls, as ZpipesLib
+    has them:
+
+      fn_open(server, pipe_name)               -> handle, or 0/None
+      fn_read(handle, address, length, timeout) -> bytes read, 0 at
+                                                  EOF, -1 on timeout
+      fn_write(handle, address, length, timeout) -> bytes written, -1
+                                                   on timeout
+      fn_close(byref(handle))
+      fn_error()                               -> errno of the last failure
+
+    Handles and lengths may arrive as ctypes values and addresses are
+    raw pointers.  Timeouts are in ms, 0 meaning none.
+    """
+    _backends[name] = factory
+
+
+def set_backend(backend):
+    """
+    Use backend for pipes opened from now on, in place of the one
+    load_library() would pick.  Returns the previous one (or None).
+    """
+    global _library
+
+    with _library_lock:
+        previous, _library = _library, backend
+    return previous
+
+
+def load_library():
+    """
+    Return the process-wide backend, creating it on first use: the
+    ctypes client (ZpipesLib, whose library path is taken from
+    ZPIPES_LIB_PATH) unless ZPIPES_BACKEND names another.
+    """
+    global _library
+
+    if _library is None:
+        with _library_lock:
+            if _library is None:
+                name = os.environ.get('ZPIPES_BACKEND', 'ctypes')
+                if name not in _backends:
+                    raise ValueError('Unknown backend: %s' % name)
+                _library = _backends[name]()
+    return _library
+
+
+class Zpipe(io.RawIOBase):
+    """
+    A zbroker pipe as a raw, unbuffered stream.  Descriptors are
+    'broker|name' for the reading end and 'broker|>name' for the
+    writing end.  Being an io.RawIOBase, a Zpipe can be wrapped in
+    io.BufferedReader/BufferedWriter (see open_buffered()).
+
+    With write_buffer_size set, writes are coalesced and sent once that
+    many bytes are pending, after write_flush_interval seconds (if
+    given), or on flush()/close().
+
+    With read_ahead set, a background thread keeps reading up to that
+    many bytes ahead of the consumer, resuming once the buffered data
+    drops to read_ahead_low (half of read_ahead by default).
+
+    timeout_mode picks how read_timeout/write_timeout apply to calls
+    that need several native reads or writes (see TIMEOUT_MODES).
+
+    pool, a zbroker.pool.HandlePool, supplies an already opened client
+    handle for the descriptor when it has one.
+
+    metrics holds the pipe's counters and native-call latencies, which
+    zbroker.metrics also totals across the process.  Native calls are
+    also traced while zbroker.trace is on.
+    """
+    def __init__(self, descriptor, read_timeout=0, write_timeout=0,
+                 read_chunk_size=None, adaptive_read=None,
+                 write_buffer_size=0, write_flush_interval=None,
+                 read_ahead=0, read_ahead_low=None, timeout_mode=None,
+                 pool=None):
+        self._closed = True
+        self.pool = pool
+
+        self.lib = load_library()
+
+        self.fn_open = self.lib.fn_open
+        self.fn_read = self.lib.fn_read
+        self.fn_write = self.lib.fn_write
+        self.fn_close = self.lib.fn_close
+        self.fn_error = self.lib.fn_error
+
         self.eof = False
-        self.closed = True
+        # what a read() that timed out part way through had received
+        self._unread = bytearray()
 
         self.read_timeout = read_timeout
         self.write_timeout = write_timeout
 
-        self.open(descriptor)
+        if timeout_mode is None:
+            timeout_mode = os.environ.get('ZPIPES_TIMEOUT_MODE',
+                                          TIMEOUT_PER_CALL)
+        if timeout_mode not in TIMEOUT_MODES:
+            raise ValueError('timeout_mode must be one of %s' % (TIMEOUT_MODES,))
+        self.timeout_mode = timeout_mode
+
+        if read_chunk_size is None:
+            read_chunk_size = int(os.environ.get('ZPIPES_READ_CHUNK_SIZE',
+                                                 READ_CHUNK_SIZE))
+        if adaptive_read is None:
+            adaptive_read = os.environ.get('ZPIPES_READ_ADAPTIVE', '0') == '1'
+
+        if read_chunk_size <= 0:
+            raise ValueError('read_chunk_size must be positive')
+
+        self.read_chunk_size = read_chunk_size
+        self.adaptive_read = adaptive_read
+        self.read_counters = { 'reads': 0,
+                               'full': 0,
+                               'short': 0,
+                               'grown': 0,
+                               'shrunk': 0 }
+
+        self.write_buffer_size = write_buffer_size
+        self.write_flush_interval = write_flush_interval
+        self._write_buffer = bytearray()
+        self._write_lock = Lock()
+        self._write_timer = None
+        self._write_error = None
+
+        self._read_ahead = None
+
+        self.metrics = metrics.PipeStats(descriptor)
+        metrics.register(self.metrics)
+
+        try:
+            self.open(descriptor)
+        except Exception:
+            # a pipe that never opened must not stay counted as live
+            metrics.retire(self.metrics)
+            raise
+
+        if read_ahead and self.readable():
+            if read_ahead_low is None:
+                read_ahead_low = read_ahead // 2
+            self._read_ahead = _ReadAhead(self, read_ahead, read_ahead_low)
 
     def read_timeout(self, read_timeout):
         self.read_timeout = read_timeout
@@ -70,21 +356,72 @@ class Zpipe(object):
         if self.pipe_name.startswith('>'):
             self.mode = 'w'
 
-        self.pipe_handle = ctypes.c_void_p(self.fn_open(self.server, self.pipe_name))
-        if self.pipe_handle == 0:
+        handle = None
+        if self.pool is not None:
+            handle = self.pool.acquire(self.server, self.pipe_name)
+        if handle is None:
+            start = _monotonic()
+            handle = self.fn_open(self.server, self.pipe_name)
+            self._record_call('new', start)
+
+        self.pipe_handle = ctypes.c_void_p(handle)
+        if not self.pipe_handle.value:
             raise IOError('Could not connect to broker')
-        self.closed = False
+        self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
 
     def close(self):
-        if self.closed is False:
-            self.fn_close(ctypes.byref(self.pipe_handle))
-            self.closed = True
+        if self._closed is False:
+            try:
+                super(Zpipe, self).close()
+            finally:
+                self._cancel_write_timer()
+                if self._read_ahead is not None:
+                    self._read_ahead.stop()
+                start = _monotonic()
+                self.fn_close(ctypes.byref(self.pipe_handle))
+                self._record_call('destroy', start)
+                metrics.retire(self.metrics)
+                self._closed = True
 
     def fileno(self):
+        """
+        For read-ahead pipes, a descriptor that polls readable whenever
+        read() would not block (data buffered, EOF or an error).  Other
+        pipes have nothing to poll.
+        """
+        if self._closed:
+            raise ValueError('fileno of closed file')
+        if self._read_ahead is not None:
+            return self._read_ahead.ready_fd
         raise IOError('this IO object does not use a file descriptor')
 
-    # def flush(self):
-    #     pass
+    def write_ready(self):
+        """
+        Whether a write would be accepted without a native call.  Only
+        a coalescing pipe with room in its buffer can promise that; any
+        other open writer is reported ready, as the client library
+        offers no way to ask.
+        """
+        if self.closed or not self.writable():
+            return False
+        if self.write_buffer_size:
+            return len(self._write_buffer) < self.write_buffer_size
+        return True
+
+    def flush(self, timeout=None):
+        if self.closed:
+            raise ValueError('flush of closed file')
+
+        if timeout is None:
+            timeout = self.write_timeout
+
+        with self._write_lock:
+            self._raise_write_error()
+            self._flush_write_buffer(timeout)
 
     def isatty(self):
         return False
@@ -94,85 +431,463 @@ class Zpipe(object):
             return True
         return False
 
-    def read(self, size=-1, timeout=None):
-        if timeout is None:
-            timeout = self.read_timeout
-
+    def _check_readable(self):
         if not self.readable():
             raise IOError('IO object not readable')
         if self.closed:
             raise IOError('Read on closed object')
-        if self.eof:
-            raise IOError('Read past EOF')
 
+    def _deadline(self, timeout):
+        if self.timeout_mode == TIMEOUT_DEADLINE:
+            return _deadline(timeout)
+        return None
 
-        bytes_to_read = size if size != -1 else 4294967296 # 4G
-        total_bytes_read = 0;
+    def _record_call(self, call, start, length=None, result=None):
+        elapsed = _monotonic() - start
+        self.metrics.record(call, elapsed)
+        if trace.tracer is not None:
+            args = { 'descriptor': self.descriptor }
+            if length is not None:
+                args['length'] = length
+                args['result'] = result
+            trace.tracer.complete('zpipes_client_' + call, 'zpipes',
+                                  start, elapsed, args)
 
-        result = ""
+    def _native_read(self, address, length, timeout, poll=False):
+        start = _monotonic()
+        bytes_read = self.fn_read(self.pipe_handle, address, ctypes.c_ulong(length), timeout)
 
-        while not self.eof and bytes_to_read > 0:
-            read_len = min(bytes_to_read, 4096)
-            buf = ctypes.create_string_buffer(read_len + 1)
-            bytes_read = self.fn_read(self.pipe_handle, buf, ctypes.c_ulong(read_len), timeout)
+        counters = self.metrics.counters
+        if bytes_read == -1 and poll:
+            # a background poll that found nothing: neither a timeout
+            # anyone saw nor a read latency worth recording
+            counters['idle_polls'] += 1
+            raise TimeoutError('Read Timeout: %d' % self.fn_error())
 
-            if bytes_read == 0:
+        self._record_call('read', start, length, bytes_read)
+        self.read_counters['reads'] += 1
+
+        if bytes_read == -1:
+            counters['read_timeouts'] += 1
+            raise TimeoutError('Read Timeout: %d' % self.fn_error())
+
+            # if self.fn_error() == errno.EAGAIN:
+            #     raise TimeoutError('Read timeout: %d' % self.fn_error())
+
+            # raise IOError('Read error: %d' % self.fn_error())
+
+        if bytes_read == 0:
+            counters['eofs'] += 1
+            # the read-ahead thread's EOF is the pipe's only once its
+            # queue has been drained (see _ReadAhead.read)
+            if not poll:
                 self.eof = True
-                return result
+        else:
+            counters['reads'] += 1
+            counters['bytes_read'] += bytes_read
+            self._note_read(length, bytes_read)
 
-            if bytes_read == -1:
-                raise TimeoutError('Read Timeout: %d' % self.fn_error())
+        return bytes_read
 
-                # if self.fn_error() == errno.EAGAIN:
-                #     raise TimeoutError('Read timeout: %d' % self.fn_error())
+    def read(self, size=-1, timeout=None):
+        if timeout is None:
+            timeout = self.read_timeout
+        if size is None or size < 0:
+            size = -1
 
-                # raise IOError('Read error: %d' % self.fn_error())
+        self._check_readable()
+        if self._read_ahead is not None:
+            return self._read_ahead.read(size, timeout)
 
-            total_bytes_read += bytes_read
-            result = result + buf.raw[0:bytes_read]
-            bytes_to_read -= bytes_read
+        bytes_to_read = size if size != -1 else 4294967296 # 4G
+        if len(self._unread) >= bytes_to_read:
+            return self._take_unread(bytes_to_read)
+        if self.eof:
+            return self._take_unread(len(self._unread))
 
-        return result
+        buf, self._unread = self._unread, bytearray()
+        total_bytes_read = len(buf)
+        initial = min(bytes_to_read, READ_BUFFER_SIZE)
+        if total_bytes_read < initial:
+            buf.extend(bytearray(initial - total_bytes_read))
+        deadline = self._deadline(timeout)
 
-    # def readinto(self):
-    #     pass
+        try:
+            while not self.eof and total_bytes_read < bytes_to_read:
+                read_len = min(bytes_to_read - total_bytes_read, self.read_chunk_size)
 
-    # def readline(self, limit=-1):
-    #     pass
+                if total_bytes_read + read_len > len(buf):
+                    # grow geometrically so the whole read stays linear in
+                    # the amount of data received
+                    new_len = min(max(len(buf) * 2, total_bytes_read + read_len),
+                                  bytes_to_read)
+                    buf.extend(bytearray(new_len - len(buf)))
 
-    # def readlines(self, hint=-1):
-    #     pass
+                address = _buffer_address(buf) + total_bytes_read
+                bytes_read = self._native_read(address, read_len,
+                                               _remaining(timeout, deadline, 'Read'))
+                total_bytes_read += bytes_read
+        except Exception:
+            # a timeout part way through (expected with a deadline)
+            # leaves what was received for the next read
+            del buf[total_bytes_read:]
+            self._unread = buf
+            raise
 
-    # def seek(self, offset, whence=io.SEEK_SET):
-    #     raise IOError('not seekable')
+        del buf[total_bytes_read:]
+        return bytes(buf)
 
-    def seekable(self):
-        return False
+    def _take_unread(self, size):
+        data = bytes(self._unread[:size])
+        del self._unread[:size]
+        return data
+
+    def _note_read(self, requested, bytes_read):
+        """
+        Feed a native read of requested bytes to the chunk size,
+        whoever made it.  A full read smaller than the chunk size
+        (capped by the caller) says nothing about what the pipe could
+        have delivered, but a short one still shows the chunk is too big.
+        """
+        chunk_size = self.read_chunk_size
+        if requested >= chunk_size or bytes_read < requested:
+            self._adapt_read_chunk(chunk_size, min(bytes_read, chunk_size))
+
+    def _adapt_read_chunk(self, requested, bytes_read):
+        if bytes_read == requested:
+            self.read_counters['full'] += 1
+            if self.adaptive_read and requested < READ_CHUNK_MAX:
+                self.read_chunk_size = min(requested * 2, READ_CHUNK_MAX)
+                self.read_counters['grown'] += 1
+        else:
+            self.read_counters['short'] += 1
+            if self.adaptive_read and requested > READ_CHUNK_MIN:
+                self.read_chunk_size = max(requested // 2, READ_CHUNK_MIN)
+                self.read_counters['shrunk'] += 1
+
+    def readinto(self, buffer, timeout=None):
+        """
+        Read directly into a writable buffer (bytearray or similar) with
+        a single native read.  Returns the number of bytes stored, 0 at
+        EOF.
+        """
+        if timeout is None:
+            timeout = self.read_timeout
+
+        self._check_readable()
+        if self._read_ahead is not None:
+            return self._read_ahead.readinto(buffer, timeout)
+        if self._unread:
+            data = self._take_unread(len(buffer))
+            buffer[:len(data)] = data
+            return len(data)
+        if self.eof or len(buffer) == 0:
+            return 0
+
+        try:
+            address = _buffer_address(buffer)
+        except TypeError:
+            # python 2 memoryviews (as handed to us by io.BufferedReader)
+            # don't expose their address to ctypes: stage the data
+            staging = bytearray(len(buffer))
+            bytes_read = self._native_read(_buffer_address(staging),
+                                           len(staging), timeout)
+            buffer[:bytes_read] = staging[:bytes_read]
+            return bytes_read
+
+        return self._native_read(address, len(buffer), timeout)
+
+    def iter_chunks(self, chunk_size=None, size=-1, timeout=None):
+        """
+        Yield data as it arrives, at most chunk_size bytes (by default
+        read_chunk_size, following it as it adapts) at a time, until EOF
+        or until size bytes have been yielded.  Memory use is bounded by
+        the chunk size however much data flows through.
+        """
+        follow = chunk_size is None
+        if follow:
+            chunk_size = self.read_chunk_size
+        if timeout is None:
+            timeout = self.read_timeout
+
+        deadline = self._deadline(timeout)
+        buf = bytearray(chunk_size)
+        remaining = size
+
+        while remaining != 0:
+            if follow and len(buf) != self.read_chunk_size:
+                buf = bytearray(self.read_chunk_size)
+            if 0 < remaining < len(buf):
+                buf = bytearray(remaining)
+
+            bytes_read = self.readinto(buf, _remaining(timeout, deadline, 'Read'))
+            if bytes_read == 0:
+                return
 
-    # def tell(self):
-    #     raise IOError('not seekable')
+            if remaining > 0:
+                remaining -= bytes_read
+            yield bytes(buf[:bytes_read])
 
-    # def truncate(size=None):
-    #     raise IOError('not seekable')
+    def recv_to_file(self, path_or_fd, offset=0, timeout=None):
+        """
+        Read until EOF into a file starting at offset.  The file is
+        extended and memory mapped FILE_WINDOW_SIZE bytes at a time, and
+        the native client reads straight into the mapping (read-ahead
+        pipes copy out of their buffer into it instead).  Returns the
+        bytes received; the file is truncated to end with them.  A path
+        is only truncated on open when offset is 0.
+        """
+        if timeout is None:
+            timeout = self.read_timeout
+
+        self._check_readable()
+
+        flags = os.O_RDWR | os.O_CREAT
+        if not offset:
+            flags |= os.O_TRUNC
+        fd, owned = _file_descriptor(path_or_fd, flags)
+        deadline = self._deadline(timeout)
+        position = offset
+        bytes_read = None
+
+        try:
+            while bytes_read != 0:
+                base = position - position % mmap.ALLOCATIONGRANULARITY
+                length = FILE_WINDOW_SIZE
+                if os.fstat(fd).st_size < base + length:
+                    os.ftruncate(fd, base + length)
+
+                window = mmap.mmap(fd, length, offset=base)
+                filled = position - base
+                try:
+                    while filled < length:
+                        remaining = _remaining(timeout, deadline, 'Read')
+                        address = _buffer_address(window) + filled
+                        if self._unread:
+                            data = self._take_unread(length - filled)
+                            window[filled:filled + len(data)] = data
+                            bytes_read = len(data)
+                        elif self.eof:
+                            bytes_read = 0
+                        elif self._read_ahead is not None:
+                            bytes_read = self._read_ahead.read_address(
+                                address, length - filled, remaining)
+                        else:
+                            bytes_read = self._native_read(address, length - filled,
+                                                           remaining)
+                        if bytes_read == 0:
+                            break
+                        filled += bytes_read
+                finally:
+                    window.close()
+                    position = base + filled
+        finally:
+            # a timeout or error still leaves the file ending with the
+            # data received, rather than padded out to the window
+            try:
+                os.ftruncate(fd, position)
+            finally:
+                if owned:
+                    os.close(fd)
+
+        return position - offset
+
+    def seekable(self):
+        return False
 
     def writable(self):
         if 'w' in self.mode:
             return True
         return False
 
+    def _check_writable(self):
+        if not self.writable():
+            raise IOError('IO object not writable')
+        if self.closed:
+            raise IOError('Write to closed file')
+
     def write(self, str, timeout=None):
         if timeout is None:
             timeout = self.write_timeout
 
-        if not self.writable():
-            raise IOError('IO object not writable')
+        self._check_writable()
 
-        if self.closed:
-            raise IOError('Write to closed file')
+        if not self.write_buffer_size:
+            with self._write_lock:
+                # anything left queued by a write_many() that timed
+                # out goes first
+                self._raise_write_error()
+                deadline = self._deadline(timeout)
+                self._flush_write_buffer(timeout, deadline)
+                return self._native_write(str, _remaining(timeout, deadline, 'Write'))
+
+        with self._write_lock:
+            self._raise_write_error()
+            self._write_buffer.extend(str)
+
+            if len(self._write_buffer) >= self.write_buffer_size:
+                self._flush_write_buffer(timeout)
+            elif self.write_flush_interval is not None and self._write_timer is None:
+                self._write_timer = Timer(self.write_flush_interval,
+                                          self._flush_on_timer)
+                self._write_timer.daemon = True
+                self._write_timer.start()
+
+        return len(str)
+
+    def writeall(self, data, timeout=None):
+        """
+        Write all of data, looping on short writes, within one overall
+        timeout rather than one per native write.  data can be any
+        bytes-like object, and bytes or writable buffers are sent
+        without being copied.  Returns len(data).
+        """
+        if timeout is None:
+            timeout = self.write_timeout
+
+        self._check_writable()
+
+        with self._write_lock:
+            self._raise_write_error()
+            deadline = _deadline(timeout)
+            self._flush_write_buffer(timeout, deadline)
+
+            address, length, owner = _readable_buffer(data)
+            self._writeall_address(address, length, timeout, deadline)
+
+        return length
+
+    def _writeall_address(self, address, length, timeout, deadline):
+        # called with _write_lock held
+        offset = 0
+
+        while offset < length:
+            remaining = _remaining(timeout, deadline, 'Write')
+            bytes_written = self._native_write_address(address + offset,
+                                                       length - offset,
+                                                       remaining)
+            if bytes_written == 0:
+                raise IOError('Write failed')
+            offset += bytes_written
+
+    def write_many(self, buffers, timeout=None):
+        """
+        Send a batch of buffers (along with anything already pending)
+        as a single native write.  Returns the number of bytes in the
+        batch.
+        """
+        if timeout is None:
+            timeout = self.write_timeout
+
+        self._check_writable()
+
+        with self._write_lock:
+            self._raise_write_error()
+            pending = len(self._write_buffer)
+            for buf in buffers:
+                self._write_buffer.extend(buf)
+            batch_size = len(self._write_buffer) - pending
+            self._flush_write_buffer(timeout)
+
+        return batch_size
+
+    def send_file(self, path_or_fd, offset=0, count=None, timeout=None):
+        """
+        Send count bytes (by default, the rest) of a file starting at
+        offset.  The file is memory mapped FILE_WINDOW_SIZE bytes at a
+        time and each window goes to the native client in place.  The
+        timeout covers the whole transfer.  Returns the bytes sent.
+        """
+        if timeout is None:
+            timeout = self.write_timeout
+
+        self._check_writable()
+
+        fd, owned = _file_descriptor(path_or_fd, os.O_RDONLY)
+        try:
+            file_size = os.fstat(fd).st_size
+            if count is None or offset + count > file_size:
+                count = max(file_size - offset, 0)
+
+            with self._write_lock:
+                self._raise_write_error()
+                deadline = _deadline(timeout)
+                self._flush_write_buffer(timeout, deadline)
+
+                position = offset
+                end = offset + count
+                while position < end:
+                    # mmap offsets have to be aligned to the granularity
+                    base = position - position % mmap.ALLOCATIONGRANULARITY
+                    length = min(end - base, FILE_WINDOW_SIZE)
+
+                    # a private (copy on write) map is writable as far as
+                    # ctypes is concerned, so it can be addressed in place
+                    window = mmap.mmap(fd, length, access=mmap.ACCESS_COPY,
+                                       offset=base)
+                    try:
+                        skip = position - base
+                        self._writeall_address(_buffer_address(window) + skip,
+                                               length - skip, timeout, deadline)
+                    finally:
+                        window.close()
+                    position = base + length
+        finally:
+            if owned:
+                os.close(fd)
+
+        return count
+
+    def _flush_write_buffer(self, timeout, deadline=None):
+        # called with _write_lock held
+        self._cancel_write_timer()
+
+        if deadline is None:
+            deadline = self._deadline(timeout)
+
+        while self._write_buffer:
+            bytes_written = self._native_write(self._write_buffer,
+                                               _remaining(timeout, deadline, 'Write'))
+            if bytes_written == 0:
+                raise IOError('Write failed')
+            del self._write_buffer[:bytes_written]
+
+    def _flush_on_timer(self):
+        with self._write_lock:
+            self._write_timer = None
+            if self.closed:
+                return
+            try:
+                self._flush_write_buffer(self.write_timeout)
+            except Exception as e:
+                # surfaced on the next write/flush/close
+                self._write_error = e
+
+    def _cancel_write_timer(self):
+        if self._write_timer is not None:
+            self._write_timer.cancel()
+            self._write_timer = None
 
-        bytes_written = self.fn_write(self.pipe_handle, ctypes.c_char_p(str), ctypes.c_ulong(len(str)), timeout)
+    def _raise_write_error(self):
+        if self._write_error is not None:
+            error, self._write_error = self._write_error, None
+            raise error
+
+    def _native_write(self, str, timeout):
+        address, length, owner = _readable_buffer(str)
+        return self._native_write_address(address, length, timeout)
+
+    def _native_write_address(self, address, length, timeout):
+        start = _monotonic()
+        bytes_written = self.fn_write(self.pipe_handle, address, ctypes.c_ulong(length), timeout)
+        self._record_call('write', start, length, bytes_written)
+
+        counters = self.metrics.counters
         if bytes_written < 0:
+            counters['write_timeouts'] += 1
             raise TimeoutError('Write Timeout')
+        counters['writes'] += 1
+        counters['bytes_written'] += bytes_written
         #     if self.fn_error() == errno.EAGAIN:
         #         raise TimeoutError('Write timeout')
 
@@ -180,7 +895,299 @@ class Zpipe(object):
 
         return int(bytes_written)
 
-    # def writelines(line):
-    #     if not self.writable():
-    #         raise IOError('IO object not writable')
-    #     pass
+
+class _ReadAhead(object):
+    """
+    Background reader for a Zpipe.  Chunks read from the native client
+    are queued until high_water bytes are buffered, after which the
+    thread waits for the consumer to drain the queue to low_water.
+
+    ready_fd is the read end of a pipe holding one byte while a read
+    would not block, so the Zpipe can be polled.
+    """
+    def __init__(self, pipe, high_water, low_water):
+        self.pipe = pipe
+        self.high_water = high_water
+        self.low_water = min(low_water, high_water - 1)
+
+        self.chunks = deque()
+        self.offset = 0
+        self.buffered = 0
+        self.eof = False
+        self.error = None
+        self.stopping = False
+        self.cond = Condition()
+
+        self.ready_fd, self._ready_wfd = os.pipe()
+        self._signalled = False
+
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if self.buffered >= self.high_water:
+                    while not self.stopping and self.buffered > self.low_water:
+                        self.cond.wait()
+                if self.stopping:
+                    return
+                room = self.high_water - self.buffered
+
+            chunk = bytearray(min(room, self.pipe.read_chunk_size))
+            try:
+                bytes_read = self.pipe._native_read(_buffer_address(chunk),
+                                                    len(chunk), READ_AHEAD_POLL,
+                                                    poll=True)
+            except TimeoutError:
+                # nobody may be waiting yet; consumers time out on their own
+                continue
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self._update_ready()
+                    self.cond.notify_all()
+                return
+
+            with self.cond:
+                if bytes_read == 0:
+                    self.eof = True
+                else:
+                    del chunk[bytes_read:]
+                    self.chunks.append(chunk)
+                    self.buffered += bytes_read
+                self._update_ready()
+                self.cond.notify_all()
+
+            if bytes_read == 0:
+                return
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.thread.join()
+
+        os.close(self.ready_fd)
+        os.close(self._ready_wfd)
+
+    def _update_ready(self):
+        # called with cond held
+        ready = bool(self.buffered or self.eof or self.error is not None)
+        if ready and not self._signalled:
+            os.write(self._ready_wfd, b'r')
+            self._signalled = True
+        elif not ready and self._signalled:
+            os.read(self.ready_fd, 1)
+            self._signalled = False
+
+    def _take(self, size):
+        # called with cond held and data buffered
+        chunk = self.chunks[0]
+        size = min(size, len(chunk) - self.offset)
+        data = chunk[self.offset:self.offset + size]
+        self._consume(size)
+        return data
+
+    def _take_to(self, address, size):
+        # as _take, but copies straight to memory at address
+        chunk = self.chunks[0]
+        size = min(size, len(chunk) - self.offset)
+        ctypes.memmove(address, _buffer_address(chunk) + self.offset, size)
+        self._consume(size)
+        return size
+
+    def _consume(self, size):
+        # called with cond held
+        self.offset += size
+        if self.offset == len(self.chunks[0]):
+            self.chunks.popleft()
+            self.offset = 0
+
+        self.buffered -= size
+        if self.buffered <= self.low_water:
+            self.cond.notify_all()
+        self._update_ready()
+
+    def _wait(self, deadline):
+        # called with cond held; deadline is None to wait forever.  The
+        # wait is sliced so signal handlers (e.g. SIGALRM) still get to
+        # run in the waiting thread.
+        if self.error is not None:
+            raise self.error
+
+        interval = READ_AHEAD_POLL / 1000.0
+        if deadline is not None:
+            remaining = deadline - _monotonic()
+            if remaining <= 0:
+                raise TimeoutError('Read Timeout')
+            interval = min(interval, remaining)
+        self.cond.wait(interval)
+
+    def read(self, size, timeout):
+        deadline = _deadline(timeout)
+
+        result = bytearray()
+        with self.cond:
+            try:
+                while size < 0 or len(result) < size:
+                    if self.buffered:
+                        wanted = size - len(result) if size >= 0 else self.buffered
+                        result += self._take(wanted)
+                    elif self.eof:
+                        self.pipe.eof = True
+                        break
+                    else:
+                        self._wait(deadline)
+            except Exception:
+                # leave the data for the next read rather than losing it
+                if result:
+                    if self.offset:
+                        self.chunks[0] = self.chunks[0][self.offset:]
+                        self.offset = 0
+                    self.chunks.appendleft(result)
+                    self.buffered += len(result)
+                    self._update_ready()
+                raise
+
+        return bytes(result)
+
+    def readinto(self, buffer, timeout):
+        deadline = _deadline(timeout)
+
+        with self.cond:
+            while not self.buffered:
+                if self.eof:
+                    self.pipe.eof = True
+                    return 0
+                self._wait(deadline)
+
+            bytes_read = 0
+            while self.buffered and bytes_read < len(buffer):
+                data = self._take(len(buffer) - bytes_read)
+                buffer[bytes_read:bytes_read + len(data)] = data
+                bytes_read += len(data)
+
+        return bytes_read
+
+    def read_address(self, address, size, timeout):
+        """ readinto() for size bytes of memory at address """
+        deadline = _deadline(timeout)
+
+        with self.cond:
+            while not self.buffered:
+                if self.eof:
+                    self.pipe.eof = True
+                    return 0
+                self._wait(deadline)
+
+            bytes_read = 0
+            while self.buffered and bytes_read < size:
+                bytes_read += self._take_to(address + bytes_read, size - bytes_read)
+
+        return bytes_read
+
+
+def open_buffered(descriptor, buffer_size=io.DEFAULT_BUFFER_SIZE, **kwargs):
+    """
+    Open a Zpipe wrapped in an io.BufferedReader or io.BufferedWriter,
+    depending on the direction of the descriptor.  Extra keyword
+    arguments are passed on to Zpipe.
+    """
+    pipe = Zpipe(descriptor, **kwargs)
+    if pipe.writable():
+        return io.BufferedWriter(pipe, buffer_size)
+    return io.BufferedReader(pipe, buffer_size)
+
+
+def open_pipe(descriptor, **kwargs):
+    """
+    Open a descriptor that may name a codec in a third field, as in
+    'broker|>name|zlib', in which case the result is a CompressedZpipe
+    over the pipe 'broker|>name'.  Both ends must name the same codec.
+    Extra keyword arguments are passed on to Zpipe.
+    """
+    fields = descriptor.split('|')
+    if len(fields) == 3:
+        server, pipe_name, codec = fields
+        return CompressedZpipe(Zpipe('%s|%s' % (server, pipe_name), **kwargs), codec)
+    return Zpipe(descriptor, **kwargs)
+
+
+def open_many(descriptors, max_workers=OPEN_MANY_WORKERS, **kwargs):
+    """
+    Open each descriptor as open_pipe() would, up to max_workers at a
+    time, returning the pipes in the order given.  The native open
+    releases the GIL, so the waits overlap.  If any open fails, no
+    more are started, the pipes already opened are closed and the
+    first error is raised.
+    """
+    if max_workers <= 0:
+        raise ValueError('max_workers must be positive')
+
+    descriptors = list(descriptors)
+    pipes = [None] * len(descriptors)
+    errors = []
+    lock = Lock()
+    pending = iter(range(len(descriptors)))
+
+    def work():
+        while True:
+            with lock:
+                if errors:
+                    return
+                index = next(pending, None)
+            if index is None:
+                return
+
+            try:
+                pipes[index] = open_pipe(descriptors[index], **kwargs)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                return
+
+    workers = [Thread(target=work)
+               for index in range(min(max_workers, len(descriptors)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    try:
+        for worker in workers:
+            # joined in slices so signals are still handled (python 2)
+            while worker.is_alive():
+                worker.join(0.1)
+    except BaseException as e:
+        with lock:
+            errors.append(e)
+        for worker in workers:
+            worker.join()
+
+    if errors:
+        for pipe in pipes:
+            if pipe is not None:
+                try:
+                    pipe.close()
+                except Exception:
+                    pass
+        raise errors[0]
+
+    return pipes
+
+
+from zbroker import metrics, trace
+from zbroker.compress import CompressedZpipe, register_codec
+from zbroker.inprocess import InProcessBroker
+from zbroker.pool import HandlePool
+from zbroker.records import RecordPipe
+from zbroker.relay import Relay, relay, RELAY_BLOCK, RELAY_DROP, RELAY_BUFFER
+from zbroker.selector import ZpipeSelector, EVENT_READ, EVENT_WRITE
+from zbroker.shm import SharedMemoryBackend
+
+register_backend('inprocess', InProcessBroker)
+register_backend('shm', SharedMemoryBackend)
+
+if sys.version_info >= (3, 5):
+    from zbroker.aio import AsyncZpipe
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+asyncio front end for Zpipe (python 3.5+).
+
+Reads are readiness based: the reading end is opened with read-ahead
+and its ready descriptor (Zpipe.fileno) is watched by the event loop,
+so a waiting read() occupies neither the loop nor the pool.  The
+read-ahead itself is still a daemon thread per open reading end, plus
+an os.pipe() pair and up to read_ahead bytes buffered, so many idle
+readers cost a thread each.  Opening, writing and closing block in the
+client library and run on a bounded thread pool.
+"""
+
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import zbroker
+
+# threads in the shared pool used for open/write/close
+EXECUTOR_WORKERS = 16
+
+# read-ahead buffer for the reading end of an AsyncZpipe
+ASYNC_READ_AHEAD = 65536
+
+_executor = None
+_executor_lock = Lock()
+
+
+def get_executor():
+    """ the process-wide pool used by AsyncZpipes without their own """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)
+    return _executor
+
+
+class AsyncZpipe(object):
+    """
+    Awaitable wrapper around a Zpipe, used as
+
+        async with AsyncZpipe('local|name') as pipe:
+            data = await pipe.readexactly(4)
+
+    Timeouts are in milliseconds like Zpipe's, 0 meaning none, and
+    apply to the whole awaited call.  They raise zbroker.TimeoutError.
+    Reads and drains can be cancelled or time out without losing data:
+    bytes already received stay buffered for the next read, and a write
+    already handed to the pool is completed by the next drain() or
+    close().
+    """
+    def __init__(self, descriptor, read_timeout=0, write_timeout=0,
+                 executor=None, read_ahead=ASYNC_READ_AHEAD, **kwargs):
+        if read_ahead <= 0:
+            raise ValueError('AsyncZpipe needs a positive read_ahead')
+
+        self.descriptor = descriptor
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.executor = executor
+        self.read_ahead = read_ahead
+        self.kwargs = kwargs
+
+        self.pipe = None
+        self._read_buffer = bytearray()
+        self._write_buffer = bytearray()
+        self._inflight = None
+
+    def _submit(self, fn, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor or get_executor(), fn, *args)
+
+    async def _with_timeout(self, coro, timeout, what):
+        if not timeout:
+            return await coro
+        try:
+            return await asyncio.wait_for(coro, timeout / 1000.0)
+        except asyncio.TimeoutError:
+            raise zbroker.TimeoutError('%s Timeout' % what)
+
+    async def open(self):
+        if self.pipe is not None:
+            return self
+
+        future = self._submit(functools.partial(zbroker.Zpipe,
+                                                self.descriptor,
+                                                read_ahead=self.read_ahead,
+                                                **self.kwargs))
+        try:
+            self.pipe = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(self._close_abandoned)
+            raise
+        return self
+
+    def _close_abandoned(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self._submit(future.result().close)
+
+    async def close(self):
+        if self.pipe is None:
+            return
+
+        try:
+            if self.pipe.writable():
+                await self.drain()
+        finally:
+            pipe, self.pipe = self.pipe, None
+            await self._submit(pipe.close)
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _wait_readable(self):
+        loop = asyncio.get_event_loop()
+        fd = self.pipe.fileno()
+        waiter = loop.create_future()
+
+        def ready():
+            if not waiter.done():
+                waiter.set_result(None)
+
+        loop.add_reader(fd, ready)
+        try:
+            await waiter
+        finally:
+            loop.remove_reader(fd)
+
+    async def _fill(self):
+        # the read-ahead buffer has data (or EOF) once the descriptor
+        # polls readable, so readinto() won't block the loop
+        await self._wait_readable()
+        chunk = bytearray(self.read_ahead)
+        bytes_read = self.pipe.readinto(chunk)
+        self._read_buffer += chunk[:bytes_read]
+        return bytes_read
+
+    def _take(self, size):
+        data = bytes(self._read_buffer[:size])
+        del self._read_buffer[:size]
+        return data
+
+    async def _read(self, size):
+        if size < 0:
+            while await self._fill():
+                pass
+            return self._take(len(self._read_buffer))
+
+        if size and not self._read_buffer:
+            await self._fill()
+        return self._take(size)
+
+    async def _readexactly(self, size):
+        while len(self._read_buffer) < size:
+            if not await self._fill():
+                partial = self._take(len(self._read_buffer))
+                raise asyncio.IncompleteReadError(partial, size)
+        return self._take(size)
+
+    async def read(self, size=-1, timeout=None):
+        """
+        Read up to size bytes, returning as soon as any are available,
+        or everything up to EOF for a negative size.  Returns b'' at EOF.
+        """
+        if timeout is None:
+            timeout = self.read_timeout
+        return await self._with_timeout(self._read(size), timeout, 'Read')
+
+    async def readexactly(self, size, timeout=None):
+        """
+        Read exactly size bytes, raising asyncio.IncompleteReadError if
+        EOF comes first.
+        """
+        if timeout is None:
+            timeout = self.read_timeout
+        return await self._with_timeout(self._readexactly(size), timeout, 'Read')
+
+    def write(self, data):
+        """ queue data to be sent by the next drain() """
+        if self.pipe is None or not self.pipe.writable():
+            raise IOError('IO object not writable')
+        self._write_buffer += data
+
+    async def _drain(self, timeout):
+        while self._inflight is not None or self._write_buffer:
+            if self._inflight is None:
+                data = bytes(self._write_buffer)
+                del self._write_buffer[:]
+                self._inflight = self._submit(self.pipe.writeall, data, timeout)
+
+            inflight = self._inflight
+            try:
+                await asyncio.shield(inflight)
+            finally:
+                if inflight.done():
+                    self._inflight = None
+
+    async def drain(self, timeout=None):
+        """ wait until everything written so far has been sent """
+        if timeout is None:
+            timeout = self.write_timeout
+        await self._with_timeout(self._drain(timeout), timeout, 'Write')
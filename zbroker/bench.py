@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""
+Zpipe benchmarks: open latency, throughput across chunk sizes and
+small-record rates.
+
+    python zbroker/bench.py results.json [baseline.json]
+
+Runs against the in-process backend unless ZPIPES_BACKEND says
+otherwise, so the python layer can be measured without a broker.
+Results are written as JSON; given a baseline file from an earlier
+run, each figure is also printed next to the baseline's.
+
+With any backend that crosses processes (the ctypes client, or shm for
+the same-host transport) it also measures throughput and round trip
+latency to a second process on this host, which is how the two are
+compared.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import uuid
+
+from threading import Thread
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import zbroker
+
+OPEN_COUNT = 200
+THROUGHPUT_BYTES = 64 * 1024 * 1024
+THROUGHPUT_CHUNKS = (64, 1024, 4096, 65536, 1024 * 1024)
+THROUGHPUT_MAX_WRITES = 100000
+RECORD_COUNT = 200000
+RECORD_SIZE = 64
+RECORD_BATCH = 1000
+SAME_HOST_BYTES = 64 * 1024 * 1024
+SAME_HOST_CHUNKS = (4096, 65536, 1024 * 1024)
+ROUND_TRIPS = 2000
+
+
+def _pair(**kwargs):
+    name = uuid.uuid4()
+    reader = zbroker.Zpipe('local|%s' % name, **kwargs)
+    writer = zbroker.Zpipe('local|>%s' % name)
+    return reader, writer
+
+
+def _percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+
+
+def bench_open(count=OPEN_COUNT):
+    """ time to open and to close a reader/writer pair """
+    opens = []
+    closes = []
+    for index in range(0, count):
+        start = zbroker._monotonic()
+        reader, writer = _pair()
+        opens.append(zbroker._monotonic() - start)
+
+        start = zbroker._monotonic()
+        writer.close()
+        reader.close()
+        closes.append(zbroker._monotonic() - start)
+
+    return { 'count': count,
+             'open_mean_us': sum(opens) / count * 1e6,
+             'open_p50_us': _percentile(opens, 0.5) * 1e6,
+             'open_p99_us': _percentile(opens, 0.99) * 1e6,
+             'close_mean_us': sum(closes) / count * 1e6 }
+
+
+def _drain(reader, chunk_size, result):
+    buf = bytearray(chunk_size)
+    total = 0
+    while True:
+        bytes_read = reader.readinto(buf)
+        if bytes_read == 0:
+            break
+        total += bytes_read
+    result.append(total)
+
+
+def bench_throughput(chunk_size, total=THROUGHPUT_BYTES):
+    """ writeall() chunk_size pieces while a thread reads them back """
+    reader, writer = _pair(read_chunk_size=chunk_size)
+    chunk = b'x' * chunk_size
+    count = min(max(total // chunk_size, 1), THROUGHPUT_MAX_WRITES)
+
+    received = []
+    drainer = Thread(target=_drain, args=(reader, chunk_size, received))
+    drainer.daemon = True
+
+    start = zbroker._monotonic()
+    drainer.start()
+    for index in range(0, count):
+        writer.writeall(chunk)
+    writer.close()
+    drainer.join()
+    elapsed = zbroker._monotonic() - start
+    reader.close()
+
+    return { 'chunk_size': chunk_size,
+             'bytes': received[0],
+             'seconds': elapsed,
+             'mb_per_sec': received[0] / elapsed / (1024 * 1024) }
+
+
+def _drain_records(reader, result):
+    result.append(sum([1 for record in reader]))
+
+
+def bench_records(count=RECORD_COUNT, size=RECORD_SIZE, batch=RECORD_BATCH):
+    """ RecordPipe records per second, sent in batches and one at a time """
+    results = {}
+    for mode, per_call in (('batched', batch), ('single', 1)):
+        reader, writer = _pair()
+        reader = zbroker.RecordPipe(reader)
+        writer = zbroker.RecordPipe(writer)
+        records = [b'r' * size] * per_call
+
+        received = []
+        drainer = Thread(target=_drain_records, args=(reader, received))
+        drainer.daemon = True
+
+        # single sends are slow enough that fewer give a stable figure
+        calls = count // per_call
+        if per_call == 1:
+            calls = count // 10
+
+        start = zbroker._monotonic()
+        drainer.start()
+        for index in range(0, calls):
+            writer.send_records(records)
+        writer.close()
+        drainer.join()
+        elapsed = zbroker._monotonic() - start
+        reader.close()
+
+        results[mode] = { 'records': received[0],
+                          'record_size': size,
+                          'seconds': elapsed,
+                          'records_per_sec': received[0] / elapsed }
+    return results
+
+
+def _spawn_peer(mode, name):
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                             '--peer', mode, name])
+
+
+def peer(mode, name):
+    """ the other end of the same-host benchmarks, in its own process """
+    if mode == 'drain':
+        reader = zbroker.Zpipe('local|%s' % name)
+
+        # tell the timing side its reader is up
+        ready = zbroker.Zpipe('local|>%s-ready' % name)
+        ready.writeall(b'r')
+        ready.close()
+
+        received = []
+        _drain(reader, 1024 * 1024, received)
+        reader.close()
+
+        done = zbroker.Zpipe('local|>%s-done' % name)
+        done.writeall(str(received[0]).encode())
+        done.close()
+    elif mode == 'echo':
+        ping = zbroker.Zpipe('local|%s-ping' % name)
+        pong = zbroker.Zpipe('local|>%s-pong' % name)
+        buf = bytearray(64)
+        while True:
+            bytes_read = ping.readinto(buf)
+            if bytes_read == 0:
+                break
+            pong.writeall(buf[:bytes_read])
+        pong.close()
+        ping.close()
+
+
+def bench_same_host_throughput(chunk_size, total=SAME_HOST_BYTES):
+    """ writeall() chunk_size pieces to a reader in another process """
+    name = str(uuid.uuid4())
+    child = _spawn_peer('drain', name)
+
+    writer = zbroker.Zpipe('local|>%s' % name)
+    done = zbroker.Zpipe('local|%s-done' % name)
+    chunk = b'x' * chunk_size
+
+    # keep the peer's interpreter start-up out of the timing
+    ready = zbroker.Zpipe('local|%s-ready' % name)
+    ready.read(1)
+    ready.close()
+
+    start = zbroker._monotonic()
+    for index in range(0, total // chunk_size):
+        writer.writeall(chunk)
+    writer.close()
+    received = int(done.read())
+    elapsed = zbroker._monotonic() - start
+
+    done.close()
+    child.wait()
+    return { 'chunk_size': chunk_size,
+             'bytes': received,
+             'seconds': elapsed,
+             'mb_per_sec': received / elapsed / (1024 * 1024) }
+
+
+def bench_same_host_latency(count=ROUND_TRIPS):
+    """ one byte there and back through a process echoing it """
+    name = str(uuid.uuid4())
+    child = _spawn_peer('echo', name)
+
+    ping = zbroker.Zpipe('local|>%s-ping' % name)
+    pong = zbroker.Zpipe('local|%s-pong' % name)
+
+    # an untimed round trip waits out the peer's start-up
+    ping.write(b'x')
+    pong.read(1)
+
+    samples = []
+    for index in range(0, count):
+        start = zbroker._monotonic()
+        ping.write(b'x')
+        pong.read(1)
+        samples.append(zbroker._monotonic() - start)
+
+    ping.close()
+    pong.read()
+    pong.close()
+    child.wait()
+    return { 'count': count,
+             'mean_us': sum(samples) / count * 1e6,
+             'p50_us': _percentile(samples, 0.5) * 1e6,
+             'p99_us': _percentile(samples, 0.99) * 1e6 }
+
+
+def run():
+    backend = zbroker.load_library()
+    results = { 'open': bench_open(),
+                'throughput': [bench_throughput(chunk_size)
+                               for chunk_size in THROUGHPUT_CHUNKS],
+                'records': bench_records() }
+
+    if not isinstance(backend, zbroker.InProcessBroker):
+        results['same_host'] = {
+            'throughput': [bench_same_host_throughput(chunk_size)
+                           for chunk_size in SAME_HOST_CHUNKS],
+            'round_trip': bench_same_host_latency() }
+
+    return { 'backend': backend.__class__.__name__,
+             'python': platform.python_version(),
+             'time': time.time(),
+             'results': results }
+
+
+def _figures(results):
+    """ the headline numbers, keyed by a name stable across runs """
+    figures = {}
+    for key in ('open_mean_us', 'open_p99_us', 'close_mean_us'):
+        figures['open.%s' % key] = results['open'][key]
+    for entry in results['throughput']:
+        figures['throughput.%d.mb_per_sec' % entry['chunk_size']] = entry['mb_per_sec']
+    for mode, entry in results['records'].items():
+        figures['records.%s.records_per_sec' % mode] = entry['records_per_sec']
+
+    same_host = results.get('same_host')
+    if same_host is not None:
+        for entry in same_host['throughput']:
+            figures['same_host.throughput.%d.mb_per_sec' % entry['chunk_size']] = entry['mb_per_sec']
+        for key in ('mean_us', 'p50_us', 'p99_us'):
+            figures['same_host.round_trip.%s' % key] = same_host['round_trip'][key]
+    return figures
+
+
+def report(current, baseline=None):
+    figures = _figures(current['results'])
+    previous = {}
+    if baseline is not None:
+        previous = _figures(baseline['results'])
+
+    for name in sorted(figures):
+        line = '%-40s %14.1f' % (name, figures[name])
+        if name in previous and previous[name]:
+            line += '  (baseline %.1f, x%.2f)' % (previous[name],
+                                                  figures[name] / previous[name])
+        print(line)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--peer']:
+        peer(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    if len(sys.argv) < 2:
+        sys.stderr.write('usage: %s results.json [baseline.json]\n' % sys.argv[0])
+        sys.exit(2)
+
+    os.environ.setdefault('ZPIPES_BACKEND', 'inprocess')
+
+    current = run()
+    with open(sys.argv[1], 'w') as f:
+        json.dump(current, f, indent=2, sort_keys=True)
+
+    baseline = None
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            baseline = json.load(f)
+    report(current, baseline)
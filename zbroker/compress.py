@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+import io
+import struct
+import time
+import zlib
+
+import zbroker
+
+# uncompressed bytes collected into each frame
+COMPRESS_BLOCK_SIZE = 65536
+
+# frame header: flags, payload length
+FRAME_HEADER = struct.Struct('!BI')
+FRAME_COMPRESSED = 1
+
+# ahead of the first frame: magic, then the codec's name (length
+# prefixed), so a reader can tell a plain or differently encoded
+# stream from its own
+STREAM_MAGIC = b'ZPCZ'
+STREAM_HEADER = struct.Struct('!4sB')
+
+# CPU time of the calling thread, so codec work in other threads isn't
+# counted: time.thread_time (python 3.7+), CLOCK_THREAD_CPUTIME_ID on
+# older pythons, and the per-process clock only where neither exists
+_cpu_time = getattr(time, 'thread_time', None) or \
+            zbroker._clock_gettime(zbroker._CLOCK_THREAD_CPUTIME_ID) or \
+            getattr(time, 'process_time', None) or time.clock
+
+
+class ZlibCodec(object):
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+_codecs = { 'zlib': ZlibCodec() }
+
+
+def register_codec(name, codec):
+    """
+    Make a codec available to descriptors as 'broker|name|<name>'.  A
+    codec has compress(bytes) and decompress(bytes) methods.
+    """
+    _codecs[name] = codec
+
+
+def get_codec(name):
+    if name not in _codecs:
+        raise ValueError('Unknown codec: %s' % name)
+    return _codecs[name]
+
+
+class CompressedZpipe(io.RawIOBase):
+    """
+    A Zpipe carrying compressed frames.  Writes are collected into
+    blocks of block_size bytes, each sent as one frame (header plus
+    payload) on flush(), close() or once a block fills.  A block that
+    doesn't shrink is sent as is.  Reads decode the frames as they
+    arrive.  Both ends have to use the same codec, which is what the
+    third field of the descriptor given to zbroker.open_pipe is for.
+    The stream starts by naming its codec, and a reader whose codec
+    differs (or that finds no compressed stream at all) raises IOError.
+
+    compression_stats() reports the uncompressed and on-the-wire byte
+    counts, the ratio between them and the CPU time spent in the codec.
+    """
+    def __init__(self, pipe, codec='zlib', block_size=COMPRESS_BLOCK_SIZE):
+        self.pipe = pipe
+        self.codec_name = codec
+        self.codec = get_codec(codec)
+        self.block_size = block_size
+
+        self._pending = bytearray()
+        self._wire = bytearray()
+        self._decoded = bytearray()
+        self._header_sent = False
+        self._header_checked = False
+
+        self.stats = { 'bytes': 0,
+                       'wire_bytes': 0,
+                       'frames': 0,
+                       'cpu_seconds': 0.0 }
+
+    @property
+    def descriptor(self):
+        return self.pipe.descriptor
+
+    @property
+    def closed(self):
+        return self.pipe.closed
+
+    @property
+    def eof(self):
+        return self.pipe.eof and not self._decoded and not self._wire
+
+    def readable(self):
+        return self.pipe.readable()
+
+    def writable(self):
+        return self.pipe.writable()
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self.writable():
+                    self.flush()
+            finally:
+                self.pipe.close()
+
+    def flush(self, timeout=None):
+        if self.closed:
+            raise ValueError('flush of closed file')
+        if self.writable():
+            if self._pending:
+                self._send_frame(self._pending, timeout)
+                del self._pending[:]
+            self.pipe.flush(timeout)
+
+    def write(self, data, timeout=None):
+        return self._write(data, timeout, None)
+
+    def writeall(self, data, timeout=None):
+        """
+        As write(), which always takes all of data, but with timeout
+        covering every frame sent rather than each of them.  As with
+        write(), a final partial block waits for flush() or close().
+        """
+        if timeout is None:
+            timeout = self.pipe.write_timeout
+        return self._write(data, timeout, zbroker._deadline(timeout))
+
+    def _write(self, data, timeout, deadline):
+        if not self.writable():
+            raise IOError('IO object not writable')
+        if self.closed:
+            raise IOError('Write to closed file')
+
+        self._pending += data
+        while len(self._pending) >= self.block_size:
+            if deadline is not None:
+                timeout = zbroker._remaining(timeout, deadline, 'Write')
+            self._send_frame(self._pending[:self.block_size], timeout)
+            del self._pending[:self.block_size]
+
+        return len(data)
+
+    def _stream_header(self):
+        name = self.codec_name.encode('ascii')
+        return STREAM_HEADER.pack(STREAM_MAGIC, len(name)) + name
+
+    def _send_frame(self, block, timeout):
+        block = bytes(block)
+
+        start = _cpu_time()
+        payload = self.codec.compress(block)
+        self.stats['cpu_seconds'] += _cpu_time() - start
+
+        flags = FRAME_COMPRESSED
+        if len(payload) >= len(block):
+            flags, payload = 0, block
+
+        header = FRAME_HEADER.pack(flags, len(payload))
+        if not self._header_sent:
+            # once handed to write_many it is queued even on a timeout
+            header = self._stream_header() + header
+            self._header_sent = True
+        self.pipe.write_many([header, payload], timeout)
+
+        self.stats['bytes'] += len(block)
+        self.stats['wire_bytes'] += len(header) + len(payload)
+        self.stats['frames'] += 1
+
+    def _check_stream_header(self):
+        """ consume the stream header once it has arrived; False until then """
+        # checked as soon as it starts arriving, so a short plain
+        # stream isn't reported as a truncated frame
+        if not STREAM_MAGIC.startswith(bytes(self._wire[:len(STREAM_MAGIC)])):
+            raise IOError('Not a compressed stream (expected codec %s)' % self.codec_name)
+        if len(self._wire) < STREAM_HEADER.size:
+            return False
+        length = STREAM_HEADER.unpack_from(bytes(self._wire[:STREAM_HEADER.size]))[1]
+
+        end = STREAM_HEADER.size + length
+        if len(self._wire) < end:
+            return False
+        name = bytes(self._wire[STREAM_HEADER.size:end]).decode('ascii')
+        if name != self.codec_name:
+            raise IOError('Stream uses codec %s, not %s' % (name, self.codec_name))
+
+        del self._wire[:end]
+        self.stats['wire_bytes'] += end
+        self._header_checked = True
+        return True
+
+    def _decode_frames(self):
+        if not self._header_checked and not self._check_stream_header():
+            return
+
+        while len(self._wire) >= FRAME_HEADER.size:
+            flags, length = FRAME_HEADER.unpack_from(bytes(self._wire[:FRAME_HEADER.size]))
+            end = FRAME_HEADER.size + length
+            if len(self._wire) < end:
+                return
+
+            payload = bytes(self._wire[FRAME_HEADER.size:end])
+            del self._wire[:end]
+
+            if flags & FRAME_COMPRESSED:
+                start = _cpu_time()
+                payload = self.codec.decompress(payload)
+                self.stats['cpu_seconds'] += _cpu_time() - start
+
+            self._decoded += payload
+            self.stats['bytes'] += len(payload)
+            self.stats['wire_bytes'] += end
+            self.stats['frames'] += 1
+
+    def _read_wire(self, timeout):
+        """ one read from the pipe, decoding what it completes; False at EOF """
+        chunk = bytearray(self.pipe.read_chunk_size)
+        bytes_read = self.pipe.readinto(chunk, timeout)
+        if bytes_read == 0:
+            if self._wire:
+                raise IOError('Truncated compressed frame')
+            return False
+
+        self._wire += chunk[:bytes_read]
+        self._decode_frames()
+        return True
+
+    def _fill(self, timeout):
+        """ read until some data is decoded; False at EOF """
+        while not self._decoded:
+            if not self._read_wire(timeout):
+                return False
+        return True
+
+    def _take(self, size):
+        data = bytes(self._decoded[:size])
+        del self._decoded[:size]
+        return data
+
+    def readinto(self, buffer, timeout=None):
+        if not self.readable():
+            raise IOError('IO object not readable')
+        if not self._decoded and not self._fill(timeout):
+            return 0
+
+        data = self._take(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read(self, size=-1, timeout=None):
+        if not self.readable():
+            raise IOError('IO object not readable')
+        if size is None:
+            size = -1
+
+        while size < 0 or len(self._decoded) < size:
+            if not self._read_wire(timeout):
+                break
+
+        if size < 0:
+            size = len(self._decoded)
+        return self._take(size)
+
+    def iter_chunks(self, chunk_size=None, size=-1, timeout=None):
+        """ as Zpipe.iter_chunks, on the decompressed data """
+        if chunk_size is None:
+            chunk_size = self.block_size
+        remaining = size
+
+        while remaining != 0:
+            if not self._decoded and not self._fill(timeout):
+                return
+            data = self._take(chunk_size if remaining < 0 else min(chunk_size, remaining))
+            if remaining > 0:
+                remaining -= len(data)
+            yield data
+
+    def compression_stats(self):
+        stats = dict(self.stats)
+        stats['codec'] = self.codec_name
+        stats['ratio'] = 0.0
+        if stats['wire_bytes']:
+            stats['ratio'] = float(stats['bytes']) / stats['wire_bytes']
+        return stats
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+import ctypes
+import errno
+
+from collections import deque
+from threading import Condition, Lock
+
+import zbroker
+
+# bytes a pipe holds before writers block
+INPROCESS_CAPACITY = 4 * 1024 * 1024
+
+# longest single wait, so signal handlers still run (python 2)
+_WAIT_SLICE = 0.05
+
+
+class _Pipe(object):
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.chunks = deque()
+        self.offset = 0
+        self.buffered = 0
+        self.readers = 0
+        self.writers = 0
+        self.writer_closed = False
+
+
+class InProcessBroker(object):
+    """
+    A pure python stand-in for the client library, for tests and
+    benchmarks without a broker.  It is selected with
+    ZPIPES_BACKEND=inprocess or zbroker.set_backend(InProcessBroker()).
+
+    Pipes live in this process only, and every broker name shares one
+    namespace, as the nodes of a cluster do.  The semantics follow
+    tests/test_pipe_semantics.py:
+
+    - a write blocks until a reader is attached and the pipe holds
+      fewer than capacity bytes
+    - a read blocks until there is data, or EOF once the writer has
+      gone and the data is drained
+    - a pipe is discarded, with anything still in it, once both ends
+      have closed
+    - timeouts are in ms, 0 being none, and a timed out call returns
+      -1 with fn_error() giving EAGAIN
+    """
+    def __init__(self, capacity=INPROCESS_CAPACITY):
+        self.capacity = capacity
+        self.lock = Lock()
+        self.pipes = {}
+        self.handles = {}
+        self.next_handle = 1
+        self.errno = 0
+
+    def _wait(self, pipe, deadline):
+        """ one wait on the pipe's condition; False once the deadline passed """
+        if deadline is None:
+            pipe.cond.wait(_WAIT_SLICE)
+            return True
+
+        remaining = deadline - zbroker._monotonic()
+        if remaining <= 0:
+            self.errno = errno.EAGAIN
+            return False
+        pipe.cond.wait(min(remaining, _WAIT_SLICE))
+        return True
+
+    def fn_open(self, server, pipe_name):
+        writer = pipe_name.startswith('>')
+        name = pipe_name.lstrip('>')
+
+        with self.lock:
+            pipe = self.pipes.get(name)
+            if pipe is None:
+                pipe = self.pipes[name] = _Pipe()
+
+            with pipe.cond:
+                if writer:
+                    pipe.writers += 1
+                    pipe.writer_closed = False
+                else:
+                    pipe.readers += 1
+                pipe.cond.notify_all()
+
+            handle = self.next_handle
+            self.next_handle += 1
+            self.handles[handle] = (name, pipe, writer)
+        return handle
+
+    def fn_read(self, handle, address, length, timeout):
+        name, pipe, writer = self.handles[zbroker._c_value(handle)]
+        address = zbroker._c_value(address)
+        length = zbroker._c_value(length)
+        deadline = zbroker._deadline(timeout)
+
+        with pipe.cond:
+            while not pipe.buffered:
+                if pipe.writer_closed:
+                    return 0
+                if not self._wait(pipe, deadline):
+                    return -1
+
+            copied = 0
+            while copied < length and pipe.chunks:
+                chunk = pipe.chunks[0]
+                count = min(length - copied, len(chunk) - pipe.offset)
+                source = zbroker._readable_buffer(chunk)[0] + pipe.offset
+                ctypes.memmove(address + copied, source, count)
+                copied += count
+
+                pipe.offset += count
+                if pipe.offset == len(chunk):
+                    pipe.chunks.popleft()
+                    pipe.offset = 0
+
+            pipe.buffered -= copied
+            pipe.cond.notify_all()
+        return copied
+
+    def fn_write(self, handle, address, length, timeout):
+        name, pipe, writer = self.handles[zbroker._c_value(handle)]
+        length = zbroker._c_value(length)
+        data = ctypes.string_at(zbroker._c_value(address), length)
+        deadline = zbroker._deadline(timeout)
+
+        with pipe.cond:
+            while not pipe.readers or pipe.buffered >= self.capacity:
+                if not self._wait(pipe, deadline):
+                    return -1
+
+            if length:
+                pipe.chunks.append(data)
+                pipe.buffered += length
+            pipe.cond.notify_all()
+        return length
+
+    def fn_close(self, handle_ref):
+        handle = zbroker._c_value(handle_ref)
+        with self.lock:
+            entry = self.handles.pop(handle, None)
+            if entry is None:
+                return
+            name, pipe, writer = entry
+
+            with pipe.cond:
+                if writer:
+                    pipe.writers -= 1
+                    if not pipe.writers:
+                        pipe.writer_closed = True
+                else:
+                    pipe.readers -= 1
+                pipe.cond.notify_all()
+
+                if not pipe.readers and not pipe.writers:
+                    if self.pipes.get(name) is pipe:
+                        del self.pipes[name]
+
+    def fn_error(self):
+        return self.errno
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+Counters and native-call latency histograms for Zpipes.
+
+Every Zpipe carries a PipeStats (Zpipe.metrics), updated without
+locking by the pipe's own calls.  Process-wide figures are put
+together on demand by snapshot(), from the live pipes plus the totals
+folded in from pipes already closed.  Exporters registered with
+add_exporter() are handed a snapshot by export(), either on request
+or every interval seconds via export_every().
+"""
+
+import time
+
+from threading import Event, RLock, Thread
+from weakref import WeakSet
+
+CALLS = ('new', 'read', 'write', 'destroy')
+# idle_polls are the read-ahead thread's reads that found nothing; they
+# are kept out of read_timeouts and the read latencies
+COUNTERS = ('reads', 'writes', 'bytes_read', 'bytes_written',
+            'read_timeouts', 'write_timeouts', 'eofs', 'idle_polls')
+
+
+class Histogram(object):
+    """
+    Latencies in power-of-two microsecond buckets: bucket n counts
+    calls that took less than 2**n us (and at least 2**(n-1)).
+    """
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        bucket = min(int(seconds * 1000000).bit_length(), self.BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for bucket, count in enumerate(other.counts):
+            self.counts[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        """ upper bound, in seconds, of the bucket holding the fraction """
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return (2 ** bucket) / 1000000.0
+        return 0.0
+
+    def snapshot(self):
+        mean = 0.0
+        if self.count:
+            mean = self.total / self.count
+        return { 'count': self.count,
+                 'total': self.total,
+                 'mean': mean,
+                 'max': self.max,
+                 'p50': self.percentile(0.5),
+                 'p99': self.percentile(0.99),
+                 'buckets': list(self.counts) }
+
+
+class PipeStats(object):
+    def __init__(self, descriptor=None):
+        self.descriptor = descriptor
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.latency = dict([(call, Histogram()) for call in CALLS])
+
+    def record(self, call, seconds):
+        self.latency[call].record(seconds)
+
+    def merge(self, other):
+        for name, value in other.counters.items():
+            self.counters[name] += value
+        for call, histogram in other.latency.items():
+            self.latency[call].merge(histogram)
+
+    def snapshot(self):
+        return { 'descriptor': self.descriptor,
+                 'counters': dict(self.counters),
+                 'latency': dict([(call, histogram.snapshot())
+                                  for call, histogram in self.latency.items()]) }
+
+
+# reentrant: collecting an unclosed Zpipe while the lock is held (the
+# allocations in register() can trigger it) closes the pipe, and so
+# retires its stats, in the same thread
+_lock = RLock()
+_live = WeakSet()
+_retired = PipeStats()
+_exporters = []
+
+
+def register(stats):
+    with _lock:
+        _live.add(stats)
+
+
+def retire(stats):
+    """ fold a closed pipe's figures into the process totals """
+    with _lock:
+        if stats in _live:
+            _live.discard(stats)
+            _retired.merge(stats)
+
+
+def snapshot(per_pipe=False):
+    """
+    Process-wide totals, plus one entry per open pipe if per_pipe is
+    set
+    """
+    with _lock:
+        live = list(_live)
+        total = PipeStats()
+        total.merge(_retired)
+
+    for stats in live:
+        total.merge(stats)
+
+    result = { 'time': time.time(),
+               'open_pipes': len(live),
+               'total': total.snapshot() }
+    if per_pipe:
+        result['pipes'] = [stats.snapshot() for stats in live]
+    return result
+
+
+def format_snapshot(snap=None):
+    """ a human readable rendering of snapshot() """
+    if snap is None:
+        snap = snapshot(per_pipe=True)
+
+    sections = [('total', snap['total'])]
+    for pipe in snap.get('pipes', []):
+        sections.append((pipe['descriptor'], pipe))
+
+    lines = ['open pipes: %d' % snap['open_pipes']]
+    for name, stats in sections:
+        lines.append('[%s]' % name)
+        for counter in COUNTERS:
+            lines.append('  %-15s %d' % (counter, stats['counters'][counter]))
+        for call in CALLS:
+            latency = stats['latency'][call]
+            if latency['count']:
+                lines.append('  %-8s n=%d mean=%.1fus p50<%.0fus p99<%.0fus max=%.1fus' %
+                             (call, latency['count'], latency['mean'] * 1e6,
+                              latency['p50'] * 1e6, latency['p99'] * 1e6,
+                              latency['max'] * 1e6))
+    return '\n'.join(lines) + '\n'
+
+
+def add_exporter(callback):
+    """ callback(snapshot) is run by every export() """
+    _exporters.append(callback)
+
+
+def remove_exporter(callback):
+    _exporters.remove(callback)
+
+
+def export(per_pipe=False):
+    snap = snapshot(per_pipe)
+    for callback in list(_exporters):
+        callback(snap)
+    return snap
+
+
+def export_every(interval, per_pipe=False):
+    """
+    export() every interval seconds from a daemon thread.  Returns an
+    Event; set it to stop.
+    """
+    stop = Event()
+
+    def run():
+        while not stop.wait(interval):
+            export(per_pipe)
+
+    thread = Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return stop
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import ctypes
+
+from collections import deque
+from threading import Event, Lock, Thread
+
+import zbroker
+
+
+class HandlePool(object):
+    """
+    Client handles opened ahead of time, so that opening a Zpipe with
+    pool=... can skip zpipes_client_new.
+
+    A client handle belongs to one pipe on one broker, and destroying
+    it is what ends the pipe for the other side, so handles are keyed
+    by (broker, pipe name) and Zpipe.close() still destroys them rather
+    than giving them back.  Handles only come from warm(): a warm
+    handle is a live open of the pipe, so warming the writing end
+    attaches a writer and evicting it closes that writer.  The pool
+    never opens one of its own while a handed out handle may still be
+    in use, since a second writer would keep the reader from seeing
+    EOF when the caller closes theirs.
+
+    Handles left unused for ttl seconds are destroyed by a background
+    reaper.  hits/misses/evictions count how acquire() went.
+    """
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+
+        self.handles = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._closing = Event()
+        self._reaper = None
+        if ttl:
+            self._reaper = Thread(target=self._reap)
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def warm(self, descriptor, count=1):
+        """ open count handles for descriptor ('broker|name') """
+        server, pipe_name = descriptor.split('|')
+        lib = zbroker.load_library()
+
+        for index in range(0, count):
+            handle = lib.fn_open(server, pipe_name)
+            if not handle:
+                raise IOError('Could not connect to broker')
+            with self.lock:
+                handles = self.handles.setdefault((server, pipe_name), deque())
+                handles.append((handle, zbroker._monotonic()))
+
+    def acquire(self, server, pipe_name):
+        """ a warm handle for the pipe, or None if there isn't one """
+        key = (server, pipe_name)
+        with self.lock:
+            handles = self.handles.get(key)
+            if not handles:
+                self.misses += 1
+                return None
+            handle, opened = handles.popleft()
+            self.hits += 1
+
+        return handle
+
+    def evict_idle(self):
+        """ destroy the handles that have been waiting longer than ttl """
+        now = zbroker._monotonic()
+        expired = []
+
+        with self.lock:
+            for handles in self.handles.values():
+                while handles and now - handles[0][1] > self.ttl:
+                    expired.append(handles.popleft()[0])
+            self.evictions += len(expired)
+
+        for handle in expired:
+            self._destroy(handle)
+
+    def _reap(self):
+        while not self._closing.wait(self.ttl / 2.0):
+            self.evict_idle()
+
+    def _destroy(self, handle):
+        lib = zbroker.load_library()
+        lib.fn_close(ctypes.byref(ctypes.c_void_p(handle)))
+
+    def stats(self):
+        with self.lock:
+            idle = sum([len(handles) for handles in self.handles.values()])
+            return { 'hits': self.hits,
+                     'misses': self.misses,
+                     'evictions': self.evictions,
+                     'idle': idle }
+
+    def close(self):
+        """ stop the reaper and destroy every idle handle """
+        self._closing.set()
+        with self.lock:
+            handles, self.handles = self.handles, {}
+
+        for queue in handles.values():
+            for handle, opened in queue:
+                self._destroy(handle)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import zbroker
+
+# largest record recv_records will accept
+RECORD_MAX_SIZE = 64 * 1024 * 1024
+
+# bytes asked of the pipe per read while decoding records
+RECORD_READ_SIZE = 256 * 1024
+
+
+def encode_length(length):
+    """ the varint (7 bits per byte, least significant first) prefix """
+    if length < 0x80:
+        return bytearray((length,))
+
+    prefix = bytearray()
+    while length >= 0x80:
+        prefix.append((length & 0x7f) | 0x80)
+        length >>= 7
+    prefix.append(length)
+    return prefix
+
+
+class RecordPipe(object):
+    """
+    Records over a byte stream pipe (a Zpipe or CompressedZpipe).  Each
+    record is sent as a varint length followed by its bytes.  A batch
+    of records goes out as a single write, and reads pull in
+    RECORD_READ_SIZE bytes at a time and decode every complete record
+    they hold.
+    """
+    def __init__(self, pipe, max_record_size=RECORD_MAX_SIZE,
+                 read_size=RECORD_READ_SIZE):
+        self.pipe = pipe
+        self.max_record_size = max_record_size
+        self.read_size = read_size
+
+        self._write = getattr(pipe, 'writeall', pipe.write)
+        self._buffer = bytearray()
+        self._offset = 0
+        self._chunk = bytearray(read_size)
+        self._eof = False
+
+    def close(self):
+        self.pipe.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def send_record(self, record, timeout=None):
+        self.send_records([record], timeout)
+
+    def send_records(self, records, timeout=None):
+        """ send a batch of records with one write; returns bytes sent """
+        batch = bytearray()
+        for record in records:
+            batch += encode_length(len(record))
+            batch += record
+
+        self._write(batch, timeout)
+        return len(batch)
+
+    def _decode(self, records, max_n):
+        buf = self._buffer
+        offset = self._offset
+        end = len(buf)
+
+        while max_n is None or len(records) < max_n:
+            # varint length
+            length = 0
+            shift = 0
+            position = offset
+            while position < end:
+                byte = buf[position]
+                position += 1
+                length |= (byte & 0x7f) << shift
+                if not byte & 0x80:
+                    break
+                shift += 7
+            else:
+                # incomplete length prefix
+                break
+
+            if length > self.max_record_size:
+                raise IOError('Record too large: %d bytes' % length)
+            if position + length > end:
+                break
+
+            records.append(bytes(buf[position:position + length]))
+            offset = position + length
+
+        # drop consumed bytes once they are the bulk of the buffer
+        if offset > len(buf) // 2:
+            del buf[:offset]
+            offset = 0
+        self._offset = offset
+
+    def _read_more(self, timeout):
+        bytes_read = self.pipe.readinto(self._chunk, timeout)
+        if bytes_read == 0:
+            self._eof = True
+            if len(self._buffer) > self._offset:
+                raise IOError('Truncated record')
+            return False
+
+        self._buffer += self._chunk[:bytes_read]
+        return True
+
+    def recv_records(self, max_n=None, timeout=None):
+        """
+        Return up to max_n records (all that are decodable by default),
+        waiting for at least one.  With a timeout (ms), it covers the
+        whole call.  Returns an empty list at EOF.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = zbroker._deadline(timeout)
+
+        records = []
+        self._decode(records, max_n)
+
+        while not records and not self._eof:
+            remaining = timeout
+            if timeout is not None:
+                remaining = zbroker._remaining(timeout, deadline, 'Read')
+            if not self._read_more(remaining):
+                break
+            self._decode(records, max_n)
+
+        return records
+
+    def __iter__(self):
+        while True:
+            records = self.recv_records()
+            if not records:
+                return
+            for record in records:
+                yield record
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+from collections import deque
+from threading import Condition, Thread
+
+import zbroker
+
+# what a relay does with an output that can't keep up
+RELAY_BLOCK = 'block'    # wait for it, holding up every output
+RELAY_DROP = 'drop'      # skip chunks while max_buffer bytes are queued
+RELAY_BUFFER = 'buffer'  # queue up to max_buffer bytes, then wait
+RELAY_POLICIES = (RELAY_BLOCK, RELAY_DROP, RELAY_BUFFER)
+
+
+class _Output(object):
+    """
+    One destination of a relay.  Under the drop and buffer policies
+    chunks are queued and written by a thread of its own.
+    """
+    def __init__(self, pipe, policy, max_buffer):
+        self.pipe = pipe
+        self.policy = policy
+        self.max_buffer = max_buffer
+
+        self.bytes = 0
+        self.dropped = 0
+        self.write_seconds = 0.0
+        self.error = None
+
+        self.queue = deque()
+        self.queued = 0
+        self.done = False
+        self.cond = Condition()
+        self.thread = None
+
+        if policy != RELAY_BLOCK:
+            self.thread = Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, data):
+        start = zbroker._monotonic()
+        self.pipe.writeall(data)
+        self.write_seconds += zbroker._monotonic() - start
+        self.bytes += len(data)
+
+    def offer(self, chunk):
+        with self.cond:
+            if self.error is not None:
+                raise self.error
+
+            if self.policy == RELAY_DROP:
+                if self.queued and self.queued + len(chunk) > self.max_buffer:
+                    self.dropped += len(chunk)
+                    return
+            else:
+                while self.queued and self.queued + len(chunk) > self.max_buffer:
+                    self.cond.wait(0.1)
+                    if self.error is not None:
+                        raise self.error
+
+            self.queue.append(chunk)
+            self.queued += len(chunk)
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.done:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                chunk = self.queue[0]
+
+            try:
+                self.write(chunk)
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self.cond.notify_all()
+                return
+
+            with self.cond:
+                self.queue.popleft()
+                self.queued -= len(chunk)
+                self.cond.notify_all()
+
+    def finish(self):
+        if self.thread is not None:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+            self.thread.join()
+
+
+class Relay(object):
+    """
+    Copy everything from a reading Zpipe to one or more writing Zpipes
+    until EOF.
+
+    Data is read into one reusable buffer.  Outputs under RELAY_BLOCK
+    are written straight from it.  For the other policies the chunk is
+    copied once and the copy is shared by their queues.  Outputs are
+    not closed.
+    """
+    def __init__(self, source, outputs, chunk_size=None,
+                 policy=RELAY_BLOCK, max_buffer=0):
+        if policy not in RELAY_POLICIES:
+            raise ValueError('policy must be one of %s' % (RELAY_POLICIES,))
+        if policy != RELAY_BLOCK and max_buffer <= 0:
+            raise ValueError('the %s policy needs a positive max_buffer' % policy)
+
+        self.source = source
+        self.chunk_size = chunk_size or source.read_chunk_size
+        self.outputs = [_Output(pipe, policy, max_buffer) for pipe in outputs]
+
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def run(self):
+        """ relay until EOF on the source; returns stats() """
+        buf = bytearray(self.chunk_size)
+        start = zbroker._monotonic()
+
+        try:
+            while True:
+                bytes_read = self.source.readinto(buf)
+                if bytes_read == 0:
+                    break
+                self.bytes += bytes_read
+
+                data = buf
+                if bytes_read < len(buf):
+                    data = memoryview(buf)[:bytes_read]
+
+                chunk = None
+                for output in self.outputs:
+                    if output.policy == RELAY_BLOCK:
+                        output.write(data)
+                    else:
+                        if chunk is None:
+                            chunk = bytes(buf[:bytes_read])
+                        output.offer(chunk)
+        finally:
+            for output in self.outputs:
+                output.finish()
+            self.elapsed = zbroker._monotonic() - start
+
+        for output in self.outputs:
+            if output.error is not None:
+                raise output.error
+
+        return self.stats()
+
+    def stats(self):
+        """
+        Bytes relayed and, for each output, bytes written, bytes
+        dropped, time spent writing and throughput in MB/s
+        """
+        outputs = []
+        for output in self.outputs:
+            rate = 0.0
+            if self.elapsed > 0:
+                rate = output.bytes / self.elapsed / (1024 * 1024)
+            outputs.append({ 'descriptor': output.pipe.descriptor,
+                             'bytes': output.bytes,
+                             'dropped': output.dropped,
+                             'write_seconds': output.write_seconds,
+                             'mb_per_sec': rate })
+
+        return { 'bytes': self.bytes,
+                 'elapsed': self.elapsed,
+                 'outputs': outputs }
+
+
+def relay(source, outputs, **kwargs):
+    """ Relay(source, outputs, **kwargs).run() """
+    return Relay(source, outputs, **kwargs).run()
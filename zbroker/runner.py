@@ -2,136 +2,720 @@
 
 import os
 import sys
+import json
 import time
 import datetime
+import threading
+import zlib
+
+from collections import deque
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 import zbroker
 
-timeout = 1000
-prefix = ''
-broker = 'local'
-pipes = {}
-expect_exception = None
-log_fd = None
+writer = None
+
+# reads longer than this are logged by size rather than content
+LOG_DATA_LIMIT = 1024
+
+# bulk data repeats a pattern this long; a prime, so a dropped or
+# repeated chunk changes the checksum
+BULK_PATTERN_SIZE = 65521
+
+# stands in for a '$prefix' argument until the instruction runs
+PREFIX = object()
+
+# the role (see 'spawn') running on this thread, named in its log lines
+_current = threading.local()
+
+# durations (ns) of every instruction run, by instruction name
+timings = {}
+
+def _monotonic_ns():
+    return int(zbroker._monotonic() * 1000000000)
+
+def _format_line(when, role, msg):
+    prefix = datetime.datetime.fromtimestamp(when).strftime("%y-%m-%d %H:%M:%S")
+    if role is not None:
+        msg = '[%s] %s' % (role, msg)
+    return '%s %s\n' % (prefix, msg)
 
 def log(msg):
-    prefix = datetime.datetime.now().strftime("%y-%m-%d %H:%M:%S")
-    if log_fd is not None:
-        log_fd.write('%s %s\n' % (prefix, msg))
-        log_fd.flush()
-    sys.stderr.write('%s %s\n' % (prefix, msg))
+    role = getattr(_current, 'role', None)
+    if writer is not None:
+        writer.put(None, (time.time(), role, msg))
+    else:
+        sys.stderr.write(_format_line(time.time(), role, msg))
+
+def event(**fields):
+    """ one line of the structured event log """
+    if writer is not None:
+        writer.put(writer.events_fd, fields)
+
+
+class LogWriter(object):
+    """
+    Writes the script log (also copied to stderr) and the JSON lines
+    event log from a thread of its own, so instructions don't wait on
+    formatting or the disk.  Lines are flushed whenever the queue runs
+    dry, and close() writes out whatever is left.
+    """
+    def __init__(self, log_path, events_path):
+        self.log_fd = open(log_path, 'w')
+        self.events_fd = open(events_path, 'w')
+
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.closing = False
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, fd, item):
+        """ queue a log line (fd None) or an event for fd """
+        with self.cond:
+            self.queue.append((fd, item))
+            self.cond.notify()
+
+    def _write(self, batch):
+        for fd, item in batch:
+            if fd is None:
+                line = _format_line(*item)
+                self.log_fd.write(line)
+                sys.stderr.write(line)
+            else:
+                fd.write(json.dumps(item, sort_keys=True) + '\n')
+
+        self.log_fd.flush()
+        self.events_fd.flush()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closing:
+                    self.cond.wait()
+                batch = list(self.queue)
+                self.queue.clear()
+                closing = self.closing
+
+            if batch:
+                self._write(batch)
+            elif closing:
+                return
+
+    def close(self):
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+        self.log_fd.close()
+        self.events_fd.close()
 
 def read_script(script_file):
+    if script_file.endswith('.yml'):
+        return read_roles(script_file)
+
     with open(script_file, 'r') as f:
         instructions = [x.strip() for x in f.readlines()]
 
     return instructions
 
-def eval(token):
-    if token == '$prefix':
-        return prefix
+def read_roles(script_file):
+    """
+    A scripts/*.yml test as one script: each node becomes a role, and
+    all of them are spawned together and joined
+    """
+    import yaml
+
+    with open(script_file, 'r') as f:
+        nodes = yaml.safe_load(f)
+
+    instructions = []
+    for node in nodes:
+        instructions.append('role %s' % node['name'])
+        instructions.extend([str(x).strip() for x in node['script']])
+        instructions.append('end')
+    instructions.extend(['spawn %s' % node['name'] for node in nodes])
+    instructions.extend(['join %s' % node['name'] for node in nodes])
+    return instructions
+
+
+class State(object):
+    """ what a run of a script changes as it goes """
+    def __init__(self, parent=None):
+        self.timeout = 1000
+        self.timeout_mode = None
+        self.prefix = ''
+        self.broker = 'local'
+        self.pipes = {}
+        self.expect_exception = None
+        self.spawned = {}
+
+        # a spawned role starts from its parent's settings, but with
+        # pipes of its own
+        if parent is not None:
+            self.timeout = parent.timeout
+            self.timeout_mode = parent.timeout_mode
+            self.prefix = parent.prefix
+            self.broker = parent.broker
+
+
+class Role(object):
+    """ the compiled body of a 'role <name>' ... 'end' block """
+    def __init__(self, name, instructions):
+        self.name = name
+        self.instructions = instructions
+
+
+class RoleFailed(Exception):
+    pass
+
+
+# instructions whose first argument is a pipe
+PIPE_INSTRUCTIONS = ('open', 'read', 'write', 'close',
+                     'write_bulk', 'write_rate', 'read_bulk')
+
+
+class Instruction(object):
+    """ one compiled script line: its handler and parsed arguments """
+    def __init__(self, lineno, line, name, handler, args):
+        self.lineno = lineno
+        self.line = line
+        self.name = name
+        self.handler = handler
+        self.args = args
+        self.dynamic = PREFIX in args
+
+    @property
+    def pipe(self):
+        if self.name in PIPE_INSTRUCTIONS and self.args[0] is not PREFIX:
+            return self.args[0]
+        return None
+
+    def __call__(self, state):
+        """ run the handler, returning the bytes it moved (if any) """
+        args = self.args
+        if self.dynamic:
+            args = [state.prefix if arg is PREFIX else arg for arg in args]
+        return self.handler(state, *args)
+
+
+class CompileError(SyntaxError):
+    pass
+
+
+# instruction name -> (handler, argument parsers, optional argument parsers)
+HANDLERS = {}
+
+def instruction(name, parsers=(), optional=()):
+    """ register a handler(state, *args) for an instruction """
+    def register(handler):
+        HANDLERS[name] = (handler, parsers, optional)
+        return handler
+    return register
+
+
+def direction(token):
+    token = token.lower()
+    if token not in ('read', 'write'):
+        raise ValueError('direction must be read or write, not "%s"' % token)
     return token
 
-def execute(instruction):
-    global prefix
-    global timeout
-    global expect_exception
-    global broker
+def timeout_mode(token):
+    if token not in zbroker.TIMEOUT_MODES:
+        raise ValueError('unknown timeout mode "%s"' % token)
+    return token
 
-    tokens = [eval(x) for x in instruction.split()]
-    if len(tokens) == 0:
-        return
-
-    if tokens[0] == 'timeout':
-        timeout = int(tokens[1])
-        log('Set timeout to %d' % timeout)
-    elif tokens[0] == 'sleep':
-        interval=int(tokens[1])
-        log('Sleeping for %d seconds' % interval)
-        time.sleep(interval)
-    elif tokens[0] == 'broker':
-        broker = tokens[1]
-        log('Set broker to %s' % broker)
-    elif tokens[0] == 'expect':
-        expect_exception = tokens[1]
-        log('Expecting exception: %s' % expect_exception)
-    elif tokens[0] == 'prefix':
-        prefix = tokens[1]
-        log('Set prefix to %s' % prefix)
-    elif tokens[0] == 'open':
-        pipe = tokens[1]
-        full_pipename = '%s-%s' % (prefix, pipe)
-        direction = tokens[2]
-        if direction.lower() == 'write':
-            full_pipename = '>%s' % full_pipename
-
-        if not pipe in pipes:
-            pipes[pipe] = { 'read': None, 'write': None }
-
-        descriptor = '%s|%s' % (broker, full_pipename)
-        log('Opening descriptor "%s"' % descriptor)
-        pipes[pipe][direction.lower()] = zbroker.Zpipe(descriptor)
-        log('Opened pipe "%s" for %s' % (pipe, direction.lower()))
-    elif tokens[0] == 'read':
-        pipe = tokens[1]
-        bytes = int(tokens[2])
+def checksum(token):
+    if token != 'checksum':
+        raise ValueError('expected "checksum", not "%s"' % token)
+    return True
+
+
+@instruction('timeout', (int,), (timeout_mode,))
+def do_timeout(state, timeout, mode=None):
+    state.timeout = timeout
+    log('Set timeout to %d' % timeout)
+    if mode is not None:
+        state.timeout_mode = mode
+        log('Set timeout mode to %s (applies to pipes opened from now on)' % mode)
+
+@instruction('sleep', (int,))
+def do_sleep(state, interval):
+    log('Sleeping for %d seconds' % interval)
+    time.sleep(interval)
+
+@instruction('broker', (str,))
+def do_broker(state, broker):
+    state.broker = broker
+    log('Set broker to %s' % broker)
+
+@instruction('expect', (str,))
+def do_expect(state, what):
+    state.expect_exception = what
+    log('Expecting exception: %s' % what)
+
+@instruction('prefix', (str,))
+def do_prefix(state, prefix):
+    state.prefix = prefix
+    log('Set prefix to %s' % prefix)
+
+@instruction('open', (str, direction), (str,))
+def do_open(state, pipe, direction, codec=None):
+    full_pipename = '%s-%s' % (state.prefix, pipe)
+    if direction == 'write':
+        full_pipename = '>%s' % full_pipename
+
+    if not pipe in state.pipes:
+        state.pipes[pipe] = { 'read': None, 'write': None }
+
+    descriptor = '%s|%s' % (state.broker, full_pipename)
+    if codec is not None:
+        descriptor = '%s|%s' % (descriptor, codec)
+    log('Opening descriptor "%s"' % descriptor)
+    state.pipes[pipe][direction] = zbroker.open_pipe(descriptor,
+                                                     timeout_mode=state.timeout_mode)
+    log('Opened pipe "%s" for %s' % (pipe, direction))
+
+@instruction('read', (str, int), (str,))
+def do_read(state, pipe, bytes, required_string=None):
+    if bytes < 0:
+        log('Reading to EOF from pipe "%s"' % pipe)
+    else:
         log('Reading %d bytes from pipe "%s"' % (bytes, pipe))
-        result=pipes[pipe]['read'].read(bytes, timeout=timeout)
-        log('Read "%s" from pipe "%s"' % (result, pipe))
-        if len(tokens) == 4:
-            required_string = tokens[3]
-            if result != required_string:
-                log('Data read did not match required string: %s' % required_string)
-                raise ValueError
-            else:
-                log('Expected data ("%s") matched' % required_string)
-    elif tokens[0] == 'write':
-        pipe = tokens[1]
-        what = tokens[2]
-        log('Writing "%s" to pipe "%s"' % (what, pipe))
-        pipes[pipe]['write'].write(what, timeout=timeout)
-        log('Wrote to pipe "%s"' % (pipe,))
-    elif tokens[0] == 'close':
-        pipe = tokens[1]
-        direction = tokens[2].lower()
-        log('Closing %s pipe "%s"' % (direction, pipe))
-        pipes[pipe][direction].close()
-        log('Closed pipe "%s"' % pipe)
+
+    # stream the data through so big reads run in constant memory;
+    # only the start of it is kept for the log
+    head = ''
+    received = 0
+    matched = True
+    for chunk in state.pipes[pipe]['read'].iter_chunks(size=bytes, timeout=state.timeout):
+        if required_string is not None:
+            expected = required_string[received:received + len(chunk)]
+            matched = matched and chunk == expected
+        if received < LOG_DATA_LIMIT:
+            head += chunk[:LOG_DATA_LIMIT - received]
+        received += len(chunk)
+
+    if received <= LOG_DATA_LIMIT:
+        log('Read "%s" from pipe "%s"' % (head, pipe))
     else:
-        log('Unknown command: "%s"' % instruction)
-        raise SyntaxError
-    return
+        log('Read %d bytes from pipe "%s"' % (received, pipe))
 
-if __name__ == '__main__':
-    script = sys.argv[1]
-    logfile = sys.argv[2]
+    if required_string is not None:
+        if not matched or received != len(required_string):
+            log('Data read did not match required string: %s' % required_string)
+            raise ValueError
+        else:
+            log('Expected data ("%s") matched' % required_string)
+    return received
+
+@instruction('write', (str, str))
+def do_write(state, pipe, what):
+    log('Writing "%s" to pipe "%s"' % (what, pipe))
+    state.pipes[pipe]['write'].write(what, timeout=state.timeout)
+    log('Wrote to pipe "%s"' % (pipe,))
+    return len(what)
 
-    log_fd = open(logfile, 'w')
+@instruction('close', (str, direction))
+def do_close(state, pipe, direction):
+    log('Closing %s pipe "%s"' % (direction, pipe))
+    state.pipes[pipe][direction].close()
+    log('Closed pipe "%s"' % pipe)
 
-    instructions = read_script(script)
+def bulk_window(chunk_size):
+    """
+    The bulk data pattern, repeated so that any chunk_size bytes of
+    the stream can be sliced from it: bytes at offset o start at
+    o % BULK_PATTERN_SIZE
+    """
+    pattern = bytearray([(index * 131 + (index >> 8)) & 0xff
+                         for index in range(0, BULK_PATTERN_SIZE)])
+    return pattern * (chunk_size // BULK_PATTERN_SIZE + 2)
+
+def bulk_checksum(total):
+    """ crc32 of the first total bytes of the bulk stream """
+    window = bulk_window(1024 * 1024)
+    crc = 0
+    offset = 0
+    while offset < total:
+        count = min(total - offset, 1024 * 1024)
+        start = offset % BULK_PATTERN_SIZE
+        crc = zlib.crc32(bytes(window[start:start + count]), crc)
+        offset += count
+    return crc & 0xffffffff
+
+def log_bulk(what, pipe, total, elapsed, latencies):
+    """ throughput and per-chunk latency figures for a bulk transfer """
+    latencies = sorted(latencies) or [0]
+    count = len(latencies)
+    rate = 0.0
+    if elapsed > 0:
+        rate = total / elapsed / (1024 * 1024)
+    log('%s %d bytes on pipe "%s" in %.3fs: %.2f MB/s, %d chunks, '
+        'latency ms p50 %.3f p90 %.3f p99 %.3f max %.3f' %
+        (what, total, pipe, elapsed, rate, count,
+         latencies[count // 2] * 1000, latencies[int(count * 0.9)] * 1000,
+         latencies[min(int(count * 0.99), count - 1)] * 1000,
+         latencies[-1] * 1000))
+
+def _write_bulk(state, pipe, total, chunk_size, mb_per_sec, check):
+    writer = state.pipes[pipe]['write']
+    window = memoryview(bulk_window(chunk_size))
+    interval = 0.0
+    if mb_per_sec:
+        interval = chunk_size / (mb_per_sec * 1024 * 1024)
+
+    latencies = []
+    crc = 0
+    offset = 0
+    start = zbroker._monotonic()
+    while offset < total:
+        if interval:
+            # pace against the schedule rather than the last chunk, so
+            # a slow write is made up for
+            delay = start + len(latencies) * interval - zbroker._monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        count = min(total - offset, chunk_size)
+        position = offset % BULK_PATTERN_SIZE
+        chunk = window[position:position + count]
+
+        sent = zbroker._monotonic()
+        writer.writeall(chunk, timeout=state.timeout)
+        latencies.append(zbroker._monotonic() - sent)
+
+        if check:
+            crc = zlib.crc32(chunk.tobytes(), crc)
+        offset += count
+    elapsed = zbroker._monotonic() - start
+
+    log_bulk('Wrote', pipe, offset, elapsed, latencies)
+    if check:
+        log('Checksum of data written to pipe "%s": %08x' % (pipe, crc & 0xffffffff))
+    return offset
+
+@instruction('write_bulk', (str, int, int), (checksum,))
+def do_write_bulk(state, pipe, total, chunk_size, check=False):
+    log('Writing %d bytes to pipe "%s" in %d byte chunks' % (total, pipe, chunk_size))
+    return _write_bulk(state, pipe, total, chunk_size, None, check)
+
+@instruction('write_rate', (str, int, int, float), (checksum,))
+def do_write_rate(state, pipe, total, chunk_size, mb_per_sec, check=False):
+    log('Writing %d bytes to pipe "%s" in %d byte chunks at %.2f MB/s' %
+        (total, pipe, chunk_size, mb_per_sec))
+    return _write_bulk(state, pipe, total, chunk_size, mb_per_sec, check)
+
+@instruction('read_bulk', (str, int), (checksum,))
+def do_read_bulk(state, pipe, total, check=False):
+    if total < 0:
+        log('Reading to EOF from pipe "%s"' % pipe)
+    else:
+        log('Reading %d bytes from pipe "%s"' % (total, pipe))
+
+    reader = state.pipes[pipe]['read']
+    buf = bytearray(getattr(reader, 'read_chunk_size', 65536))
+    latencies = []
+    crc = 0
+    received = 0
+    start = zbroker._monotonic()
+    while total < 0 or received < total:
+        wanted = len(buf)
+        if total >= 0:
+            wanted = min(wanted, total - received)
+        view = buf
+        if wanted < len(buf):
+            view = memoryview(buf)[:wanted]
+
+        began = zbroker._monotonic()
+        bytes_read = reader.readinto(view, state.timeout)
+        latencies.append(zbroker._monotonic() - began)
+        if bytes_read == 0:
+            break
+
+        if check:
+            crc = zlib.crc32(bytes(buf[:bytes_read]), crc)
+        received += bytes_read
+    elapsed = zbroker._monotonic() - start
+
+    log_bulk('Read', pipe, received, elapsed, latencies)
+    if total >= 0 and received != total:
+        log('Pipe "%s" ended after %d of %d bytes' % (pipe, received, total))
+        raise ValueError
+
+    if check:
+        crc &= 0xffffffff
+        expected = bulk_checksum(received)
+        if crc != expected:
+            log('Checksum mismatch on pipe "%s": read %08x, expected %08x' %
+                (pipe, crc, expected))
+            raise ValueError
+        log('Checksum of data read from pipe "%s" matched: %08x' % (pipe, crc))
+    return received
+
+def run_role(role, state, result):
+    _current.role = role.name
+    result.append(run(role.instructions, state))
+
+# the role argument is replaced by the compiled Role (see compile_script)
+@instruction('spawn', (str,))
+def do_spawn(state, role):
+    if role.name in state.spawned:
+        log('Role "%s" is already running' % role.name)
+        raise RoleFailed
+
+    log('Spawning role "%s"' % role.name)
+    result = []
+    thread = threading.Thread(target=run_role,
+                              args=(role, State(state), result))
+    thread.daemon = True
+    thread.start()
+    state.spawned[role.name] = (thread, result)
+
+@instruction('join', (str,))
+def do_join(state, name):
+    log('Joining role "%s"' % name)
+    if name not in state.spawned:
+        log('Role "%s" is not running' % name)
+        raise RoleFailed
+
+    thread, result = state.spawned.pop(name)
+    # joined in slices so signals are still handled (python 2)
+    while thread.is_alive():
+        thread.join(0.1)
+
+    if result != [True]:
+        log('Role "%s" failed' % name)
+        raise RoleFailed
+    log('Role "%s" passed' % name)
+
+
+def compile_line(lineno, line):
+    """ the Instruction for one line, or None for a blank one """
+    tokens = line.split()
+    if len(tokens) == 0:
+        return None
+
+    name = tokens[0]
+    if name not in HANDLERS:
+        raise CompileError('Line %d: unknown command: "%s"' % (lineno, line))
+    handler, parsers, optional = HANDLERS[name]
+
+    values = tokens[1:]
+    if not len(parsers) <= len(values) <= len(parsers) + len(optional):
+        raise CompileError('Line %d: wrong number of arguments: "%s"' % (lineno, line))
+
+    args = []
+    for parser, token in zip(parsers + optional, values):
+        if token == '$prefix':
+            args.append(PREFIX)
+            continue
+        try:
+            args.append(parser(token))
+        except ValueError as e:
+            raise CompileError('Line %d: %s: "%s"' % (lineno, e, line))
+
+    return Instruction(lineno, line, name, handler, args)
+
+
+def compile_script(lines):
+    """
+    Parse and check every line up front, returning the instructions
+    to run.  Raises CompileError for unknown commands, bad arguments,
+    pipes used before any open of them and roles spawned before they
+    are defined or joined without being spawned.
+
+    Lines between 'role <name>' and 'end' make up a role, which runs
+    on a thread of its own from 'spawn <name>' until 'join <name>'.
+    Roles share the process (and the loaded client library), so a
+    multi-node test can run as one script.
+    """
+    lines = list(enumerate(lines, 1))
+    lines.reverse()
+    instructions = _compile_block(lines, {}, None)
+    if lines:
+        lineno, line = lines[-1]
+        raise CompileError('Line %d: "end" without "role"' % lineno)
+    return instructions
+
+
+def _compile_block(lines, roles, role):
+    """ compile lines (reversed, consumed as they go) up to the end of role """
+    instructions = []
+    opened = set()
+    spawned = set()
+    while lines:
+        lineno, line = lines.pop()
+        tokens = line.split()
+
+        if tokens[:1] == ['role']:
+            if role is not None or len(tokens) != 2:
+                raise CompileError('Line %d: bad role definition: "%s"' % (lineno, line))
+            roles[tokens[1]] = Role(tokens[1], _compile_block(lines, roles, tokens[1]))
+            continue
+        if tokens == ['end']:
+            if role is None:
+                lines.append((lineno, line))
+                break
+            return instructions
+
+        compiled = compile_line(lineno, line)
+        if compiled is None:
+            continue
+
+        if compiled.name == 'spawn':
+            name = compiled.args[0]
+            if name not in roles:
+                raise CompileError('Line %d: role "%s" is not defined: "%s"' %
+                                   (lineno, name, line))
+            compiled.args[0] = roles[name]
+            spawned.add(name)
+        elif compiled.name == 'join':
+            if compiled.args[0] not in spawned:
+                raise CompileError('Line %d: role "%s" is never spawned: "%s"' %
+                                   (lineno, compiled.args[0], line))
+        elif compiled.name == 'open':
+            opened.add(compiled.args[0])
+        elif compiled.name in PIPE_INSTRUCTIONS:
+            pipe = compiled.args[0]
+            if pipe is not PREFIX and pipe not in opened:
+                raise CompileError('Line %d: pipe "%s" is never opened: "%s"' %
+                                   (lineno, pipe, line))
+        instructions.append(compiled)
+
+    if role is not None:
+        raise CompileError('Role "%s" has no "end"' % role)
+    return instructions
+
+
+def execute(instruction, state):
+    start = _monotonic_ns()
+    bytes = None
+    error = None
+    try:
+        # traced when ZPIPES_TRACE is set, see zbroker.trace
+        with zbroker.trace.span(instruction.line, 'runner'):
+            bytes = instruction(state)
+    except Exception as e:
+        error = e.__class__.__name__
+        raise
+    finally:
+        duration = _monotonic_ns() - start
+        timings.setdefault(instruction.name, []).append(duration)
+        event(ts_ns=start,
+              duration_ns=duration,
+              role=getattr(_current, 'role', None),
+              line=instruction.lineno,
+              instruction=instruction.name,
+              pipe=instruction.pipe,
+              bytes=bytes,
+              error=error)
+
+
+def summarize():
+    """ per instruction name: count and latency figures, in ms """
+    summary = {}
+    for name, durations in timings.items():
+        durations = sorted(durations)
+        count = len(durations)
+        summary[name] = { 'count': count,
+                          'total_ms': sum(durations) / 1e6,
+                          'mean_ms': sum(durations) / 1e6 / count,
+                          'p50_ms': durations[count // 2] / 1e6,
+                          'p99_ms': durations[min(int(count * 0.99), count - 1)] / 1e6,
+                          'max_ms': durations[-1] / 1e6 }
+    return summary
+
+
+def log_summary():
+    """ the latency summary, into both logs """
+    summary = summarize()
+    event(summary=summary)
+
+    log('Instruction timings (ms):')
+    log('  %-10s %6s %10s %10s %10s %10s' % ('', 'count', 'total', 'mean', 'p99', 'max'))
+    for name in sorted(summary, key=lambda name: -summary[name]['total_ms']):
+        figures = summary[name]
+        log('  %-10s %6d %10.3f %10.3f %10.3f %10.3f' %
+            (name, figures['count'], figures['total_ms'], figures['mean_ms'],
+             figures['p99_ms'], figures['max_ms']))
+
+
+def finish(passed):
+    log_summary()
+    log('Test passed' if passed else 'Test failed')
+    writer.close()
+    sys.exit(0 if passed else 1)
+
+
+def run(instructions, state=None):
+    """ run compiled instructions once, from a fresh state; True if it passed """
+    if state is None:
+        state = State()
+
+    passed = _run(instructions, state)
+
+    # roles left running are waited for, and count towards the result
+    for name in list(state.spawned):
+        try:
+            do_join(state, name)
+        except RoleFailed:
+            passed = False
+    return passed
+
+
+def _run(instructions, state):
     for instruction in instructions:
         try:
-            execute(instruction)
+            execute(instruction, state)
         except Exception as e:
             what = str(e.__class__.__name__)
-            if expect_exception is not None and what.lower() == expect_exception.lower():
+            if state.expect_exception is not None and what.lower() == state.expect_exception.lower():
                 log('Caught expected exception: %s' % what.lower())
-                expect_exception = None
+                state.expect_exception = None
             else:
                 log('Unexpected exception: %s' % what.lower())
-                log('Test failed')
-                log_fd.close()
-                sys.exit(1)
+                return False
+
+    if state.expect_exception is not None:
+        log('Expected exception "%s" did not occur' % state.expect_exception)
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    script = sys.argv[1]
+    logfile = sys.argv[2]
+    runs = 1
+    if len(sys.argv) > 3:
+        runs = int(sys.argv[3])
+
+    # the event log sits next to the script log: script.log ->
+    # script.events.jsonl
+    writer = LogWriter(logfile, os.path.splitext(logfile)[0] + '.events.jsonl')
+
+    try:
+        instructions = compile_script(read_script(script))
+    except CompileError as e:
+        log(str(e))
+        finish(False)
 
+    # resolve the native bindings before the script starts so the
+    # first 'open' isn't charged for the dlopen
+    try:
+        zbroker.load_library()
+    except Exception as e:
+        log('Unexpected exception: %s' % str(e.__class__.__name__).lower())
+        finish(False)
 
-    if expect_exception is not None:
-        log('Expected exception "%s" did not occur' % expect_exception)
-        log('Test failed')
-        log_fd.close()
-        sys.exit(1)
+    for index in range(0, runs):
+        if runs > 1:
+            log('Run %d of %d' % (index + 1, runs))
+        if not run(instructions):
+            finish(False)
 
-    log('Test passed')
-    log_fd.close()
-    sys.exit(0)
+    finish(True)
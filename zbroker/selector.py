@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import select
+
+EVENT_READ = 1
+EVENT_WRITE = 2
+
+
+class ZpipeSelector(object):
+    """
+    Wait on many Zpipes at once from a single thread.
+
+    Pipes registered for EVENT_READ must have been opened with
+    read_ahead, whose buffer is what makes them pollable (see
+    Zpipe.fileno).  EVENT_WRITE is answered by Zpipe.write_ready().
+    """
+    def __init__(self):
+        self.pipes = {}
+
+    def register(self, pipe, events=EVENT_READ, data=None):
+        if not events or events & ~(EVENT_READ | EVENT_WRITE):
+            raise ValueError('Invalid events: %r' % (events,))
+        if pipe in self.pipes:
+            raise KeyError('Zpipe already registered')
+        if events & EVENT_READ:
+            # raises IOError for pipes without read-ahead
+            pipe.fileno()
+
+        self.pipes[pipe] = (events, data)
+
+    def unregister(self, pipe):
+        return self.pipes.pop(pipe)
+
+    def modify(self, pipe, events, data=None):
+        self.unregister(pipe)
+        self.register(pipe, events, data)
+
+    def close(self):
+        self.pipes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def select(self, timeout=None):
+        """
+        Return a list of (pipe, events, data) for the registered pipes
+        that are ready, waiting up to timeout ms for one to become so.
+        None waits indefinitely and 0 polls without blocking; with no
+        open pipe to wait on, None raises ValueError rather than block
+        forever.
+        """
+        writers = {}
+        readers = {}
+        for pipe, (events, data) in self.pipes.items():
+            if events & EVENT_WRITE and pipe.write_ready():
+                writers[pipe] = EVENT_WRITE
+            if events & EVENT_READ and not pipe.closed:
+                readers[pipe.fileno()] = pipe
+
+        if not writers and not readers and timeout is None:
+            raise ValueError('No open Zpipe to wait for')
+
+        if writers:
+            # something is ready already; just check the readers
+            timeout = 0
+
+        ready = dict(writers)
+        for fd in self._poll(list(readers.keys()), timeout):
+            pipe = readers[fd]
+            ready[pipe] = ready.get(pipe, 0) | EVENT_READ
+
+        return [(pipe, events, self.pipes[pipe][1])
+                for pipe, events in ready.items()]
+
+    def _poll(self, fds, timeout):
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            for fd in fds:
+                poller.register(fd, select.POLLIN)
+            return [fd for fd, event in poller.poll(timeout)]
+
+        if timeout is not None:
+            timeout = timeout / 1000.0
+        readable, _, _ = select.select(fds, [], [], timeout)
+        return readable
@@ -23,8 +23,10 @@ class TestRunner(object):
 
         script_path = os.path.join(result_dir, 'script.txt')
         test_log_path = os.path.join(result_dir, 'script.log')
+        events_path = os.path.join(result_dir, 'script.events.jsonl')
         broker_log_path = os.path.join(result_dir, 'broker.log')
         broker_cfg_path = os.path.join(result_dir, 'zbroker.cfg')
+        trace_path = os.path.join(result_dir, 'script.trace.{pid}.json')
 
         zyre_interface = 'eth4'
 
@@ -72,6 +74,11 @@ zpipes_server
         if os.path.islink('/opt/bundler/zvm-zpipes/current'):
             env = { 'ZPIPES_LIB_PATH': '/opt/bundler/zvm-zpipes/current/lib' }
 
+        # tracing the server was started with is passed on to the
+        # runner, writing into the result directory
+        if os.environ.get('ZPIPES_TRACE'):
+            env['ZPIPES_TRACE'] = trace_path
+
         script = subprocess.Popen(['python', 'runner.py', script_path, test_log_path], env=env)
 
         print 'script running as pid %d' % script.pid
@@ -112,11 +119,33 @@ zpipes_server
         with open(test_log_path, 'r') as f:
             script_log = f.read()
 
+        # a runner killed before its first flush leaves no trace file
+        script_trace = ''
+        script_trace_path = trace_path.replace('{pid}', str(script.pid))
+        if os.path.exists(script_trace_path):
+            with open(script_trace_path, 'r') as f:
+                script_trace = f.read()
+
+        # the runner ends its event log with a per-instruction summary
+        script_timing = {}
+        if os.path.exists(events_path):
+            with open(events_path, 'r') as f:
+                for line in f:
+                    # a runner killed mid-write leaves its last line cut off
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if 'summary' in record:
+                        script_timing = record['summary']
+
         sys.stdout.flush()
 
         return { 'result': result,
                  'broker_log': broker_log,
-                 'script_log': script_log }
+                 'script_log': script_log,
+                 'script_timing': script_timing,
+                 'script_trace': script_trace }
 
     def POST(self):
         post_data = json.loads(web.data())
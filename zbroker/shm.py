@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+"""
+Same-host shared-memory transport.
+
+Pipes on the brokers named in ZPIPES_SHM_BROKERS ('local' by default)
+skip the broker: both ends map the same ring buffer file, named after
+the pipe, under ZPIPES_SHM_DIR (/dev/shm by default), and wake each
+other through a pair of FIFOs used as doorbells (one says data was
+written, the other that space was freed).  Pipes on any other broker
+are handed to the ctypes client.  It is selected with
+ZPIPES_BACKEND=shm.
+
+Each ring has one reader and one writer.  Only the writer moves
+write_pos and only the reader moves read_pos, so the data needs no
+lock; attaching and detaching take an flock on the ring file.
+"""
+
+import ctypes
+import errno
+import fcntl
+import mmap
+import os
+import select
+
+from threading import Lock
+
+import zbroker
+
+# data bytes in each ring
+SHM_RING_SIZE = 1024 * 1024
+
+SHM_DIR = '/dev/shm'
+
+# room left ahead of the data for the header
+_DATA_OFFSET = 64
+
+
+class _Header(ctypes.Structure):
+    _fields_ = [('write_pos', ctypes.c_uint64),
+                ('read_pos', ctypes.c_uint64),
+                ('readers', ctypes.c_int32),
+                ('writers', ctypes.c_int32),
+                ('writer_closed', ctypes.c_int32)]
+
+
+class _Doorbell(object):
+    """ a FIFO rung with one byte and waited on with select """
+    def __init__(self, path):
+        try:
+            os.mkfifo(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # O_RDWR so that neither end waits for the other to open it
+        self.fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+
+    def ring(self):
+        try:
+            os.write(self.fd, b'\0')
+        except OSError as e:
+            # a full FIFO is as good as a rung one
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, seconds):
+        try:
+            ready = select.select([self.fd], [], [], seconds)[0]
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if ready:
+            try:
+                os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Ring(object):
+    def __init__(self, path, ring_size, writer):
+        self.path = path
+        self.writer = writer
+
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # the last end to close unlinks the files; start over if
+            # that happened after we opened it
+            if os.fstat(fd).st_nlink:
+                break
+            os.close(fd)
+
+        try:
+            size = os.fstat(fd).st_size
+            if size == 0:
+                size = _DATA_OFFSET + ring_size
+                os.ftruncate(fd, size)
+            self.size = size - _DATA_OFFSET
+
+            self.map = mmap.mmap(fd, size)
+            self.header = _Header.from_buffer(self.map)
+            self.data = ctypes.addressof(ctypes.c_char.from_buffer(self.map, _DATA_OFFSET))
+
+            self.data_bell = _Doorbell(path + '.data')
+            self.space_bell = _Doorbell(path + '.space')
+
+            if writer:
+                self.header.writers += 1
+                self.header.writer_closed = 0
+                self.data_bell.ring()
+            else:
+                self.header.readers += 1
+                self.space_bell.ring()
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self.fd = fd
+
+    def _wait(self, bell, deadline):
+        """ one wait for the other end; False once the deadline passed """
+        seconds = None
+        if deadline is not None:
+            seconds = deadline - zbroker._monotonic()
+            if seconds <= 0:
+                return False
+        bell.wait(seconds)
+        return True
+
+    def read(self, address, length, deadline):
+        header = self.header
+        while header.write_pos == header.read_pos:
+            if header.writer_closed:
+                # the writer may have written just before closing
+                if header.write_pos == header.read_pos:
+                    return 0
+                break
+            if not self._wait(self.data_bell, deadline):
+                return -1
+
+        read_pos = header.read_pos
+        count = min(length, header.write_pos - read_pos)
+        start = read_pos % self.size
+        first = min(count, self.size - start)
+        ctypes.memmove(address, self.data + start, first)
+        if count > first:
+            ctypes.memmove(address + first, self.data, count - first)
+
+        header.read_pos = read_pos + count
+        self.space_bell.ring()
+        return count
+
+    def write(self, address, length, deadline):
+        header = self.header
+        written = 0
+
+        while not header.readers:
+            if not self._wait(self.space_bell, deadline):
+                return -1
+
+        while written < length:
+            write_pos = header.write_pos
+            free = self.size - (write_pos - header.read_pos)
+            if not free:
+                if not self._wait(self.space_bell, deadline):
+                    return written or -1
+                continue
+
+            count = min(length - written, free)
+            start = write_pos % self.size
+            first = min(count, self.size - start)
+            ctypes.memmove(self.data + start, address + written, first)
+            if count > first:
+                ctypes.memmove(self.data, address + written + first, count - first)
+
+            header.write_pos = write_pos + count
+            written += count
+            self.data_bell.ring()
+
+        return written
+
+    def close(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            header, self.header = self.header, None
+            if self.writer:
+                header.writers -= 1
+                if not header.writers:
+                    header.writer_closed = 1
+                self.data_bell.ring()
+            else:
+                header.readers -= 1
+                self.space_bell.ring()
+
+            if not header.readers and not header.writers:
+                for path in (self.path, self.path + '.data', self.path + '.space'):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+        # the header view exports the map's buffer and has to go first
+        del header
+        self.map.close()
+        self.data_bell.close()
+        self.space_bell.close()
+        os.close(self.fd)
+
+
+class SharedMemoryBackend(object):
+    """
+    Client backend (see zbroker.register_backend) carrying pipes on
+    the brokers in brokers through shared-memory rings, and all others
+    through fallback (the ctypes client unless given).
+    """
+    def __init__(self, brokers=None, ring_size=SHM_RING_SIZE,
+                 directory=None, fallback=None):
+        if brokers is None:
+            brokers = os.environ.get('ZPIPES_SHM_BROKERS', 'local').split(',')
+        if directory is None:
+            directory = os.environ.get('ZPIPES_SHM_DIR', SHM_DIR)
+
+        self.brokers = set(brokers)
+        self.ring_size = ring_size
+        self.directory = directory
+        self._fallback = fallback
+
+        self.rings = {}
+        self.lock = Lock()
+        self.next_handle = 1
+        self.errno = 0
+
+    @property
+    def fallback(self):
+        if self._fallback is None:
+            self._fallback = zbroker._backends['ctypes']()
+        return self._fallback
+
+    def _path(self, pipe_name):
+        name = pipe_name.lstrip('>').replace('/', '_')
+        return os.path.join(self.directory, 'zpipe-%s' % name)
+
+    def fn_open(self, server, pipe_name):
+        if server not in self.brokers:
+            return self.fallback.fn_open(server, pipe_name)
+
+        ring = _Ring(self._path(pipe_name), self.ring_size,
+                     pipe_name.startswith('>'))
+        # handles are odd so they can't be mistaken for a native
+        # client's (aligned) pointers
+        with self.lock:
+            handle = self.next_handle
+            self.next_handle += 2
+            self.rings[handle] = ring
+        return handle
+
+    def _ring(self, handle):
+        return self.rings.get(zbroker._c_value(handle))
+
+    def fn_read(self, handle, address, length, timeout):
+        ring = self._ring(handle)
+        if ring is None:
+            return self.fallback.fn_read(handle, address, length, timeout)
+
+        bytes_read = ring.read(zbroker._c_value(address),
+                               zbroker._c_value(length),
+                               zbroker._deadline(timeout))
+        if bytes_read < 0:
+            self.errno = errno.EAGAIN
+        return bytes_read
+
+    def fn_write(self, handle, address, length, timeout):
+        ring = self._ring(handle)
+        if ring is None:
+            return self.fallback.fn_write(handle, address, length, timeout)
+
+        bytes_written = ring.write(zbroker._c_value(address),
+                                   zbroker._c_value(length),
+                                   zbroker._deadline(timeout))
+        if bytes_written < 0:
+            self.errno = errno.EAGAIN
+        return bytes_written
+
+    def fn_close(self, handle_ref):
+        with self.lock:
+            ring = self.rings.pop(zbroker._c_value(handle_ref), None)
+        if ring is None:
+            return self.fallback.fn_close(handle_ref)
+        ring.close()
+
+    def fn_error(self):
+        return self.errno
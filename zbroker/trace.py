@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""
+Chrome trace-event output (load the file in chrome://tracing or
+Perfetto).
+
+Tracing is off unless ZPIPES_TRACE names a file or start() is called.
+While on, every native call made by a Zpipe and every runner
+instruction is recorded as a complete ('X') event.  Events are
+appended to the file TRACE_BUFFER_EVENTS at a time, and by flush(),
+stop() or at exit; each write leaves the file complete.  '{pid}' in the
+file name is replaced by the process id, so each process of a test
+gets its own file.  Timestamps are wall clock microseconds, which lets
+traces from several processes share one timeline.
+"""
+
+import atexit
+import json
+import os
+import time
+
+from threading import current_thread, Lock
+
+import zbroker
+
+# the clock Zpipe times its calls with
+_monotonic = zbroker._monotonic
+
+# events held in memory before being appended to the file
+TRACE_BUFFER_EVENTS = 1000
+
+# closes the JSON after the last event written; each write goes over it
+_TAIL = '\n],\n"displayTimeUnit": "ms"}\n'
+
+# the active Tracer, or None while tracing is off
+tracer = None
+
+
+class Tracer(object):
+    def __init__(self, path):
+        self.path = path.replace('{pid}', str(os.getpid()))
+        self.pid = os.getpid()
+        self._written = 0
+        self._pending = []
+        self._threads = set()
+        self._lock = Lock()
+
+        self._file = open(self.path, 'w')
+        self._file.write('{"traceEvents": [\n')
+        self._end = self._file.tell()
+        self._write()
+
+        # map the monotonic clock used for timing onto the wall clock
+        self._epoch = time.time() - _monotonic()
+
+    def _timestamp(self, start):
+        return int((self._epoch + start) * 1000000)
+
+    def _thread_id(self):
+        # called with _lock held
+        thread = current_thread()
+        tid = thread.ident
+        if tid not in self._threads:
+            self._threads.add(tid)
+            self._pending.append({ 'ph': 'M',
+                                   'name': 'thread_name',
+                                   'pid': self.pid,
+                                   'tid': tid,
+                                   'args': { 'name': thread.name } })
+        return tid
+
+    def complete(self, name, category, start, duration, args=None):
+        """ a span that began at start (monotonic) and lasted duration seconds """
+        event = { 'ph': 'X',
+                  'name': name,
+                  'cat': category,
+                  'pid': self.pid,
+                  'ts': self._timestamp(start),
+                  'dur': int(duration * 1000000) }
+        if args:
+            event['args'] = args
+
+        with self._lock:
+            if self._file.closed:
+                return
+            event['tid'] = self._thread_id()
+            self._pending.append(event)
+            if len(self._pending) >= TRACE_BUFFER_EVENTS:
+                self._write()
+
+    def _write(self):
+        # called with _lock held
+        f = self._file
+        f.seek(self._end)
+        for event in self._pending:
+            if self._written:
+                f.write(',\n')
+            f.write(json.dumps(event))
+            self._written += 1
+        del self._pending[:]
+
+        self._end = f.tell()
+        f.write(_TAIL)
+        f.truncate()
+        f.flush()
+
+    def flush(self):
+        """ append the buffered events to the file """
+        with self._lock:
+            if not self._file.closed:
+                self._write()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._write()
+                self._file.close()
+
+
+class _Span(object):
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = _monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        active = tracer
+        if active is not None:
+            args = self.args
+            if exc_type is not None:
+                args = dict(args or {}, exception=exc_type.__name__)
+            active.complete(self.name, self.category, self.start,
+                            _monotonic() - self.start, args)
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_no_span = _NoSpan()
+
+
+def span(name, category='zbroker', args=None):
+    """ a context manager recording its body as a span while tracing """
+    if tracer is None:
+        return _no_span
+    return _Span(name, category, args)
+
+
+def start(path):
+    """ start tracing to path, replacing any tracer already running """
+    global tracer
+
+    stop()
+    tracer = Tracer(path)
+    return tracer
+
+
+def stop():
+    """ stop tracing and write the file """
+    global tracer
+
+    active, tracer = tracer, None
+    if active is not None:
+        active.close()
+
+
+def flush():
+    if tracer is not None:
+        tracer.flush()
+
+
+atexit.register(stop)
+
+if os.environ.get('ZPIPES_TRACE'):
+    start(os.environ['ZPIPES_TRACE'])